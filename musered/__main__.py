@@ -85,11 +85,12 @@ def cli(ctx, redversion, loglevel, drslevel, settings, pdb, debug):
 
 
 @click.option("-f", "--force", is_flag=True, help="force update for existing rows")
+@click.option("--njobs", default=1, help="number of parallel process")
 @click.pass_obj
-def update_db(mr, force):
+def update_db(mr, force, njobs):
     """Create or update the database containing FITS keywords."""
     logger.info("Updating the database from the %s directory", mr.raw_path)
-    mr.update_db(force=force)
+    mr.update_db(force=force, n_jobs=njobs)
 
 
 @click.option("--type", multiple=True, help="type of file to parse (DPR.TYPE)")
@@ -4,7 +4,7 @@ import numpy as np
 from astropy.utils.decorators import lazyproperty
 from sqlalchemy import sql
 
-from .utils import ensure_list, load_table
+from .utils import ensure_list, load_table, upsert_many
 
 FLAGS = {
     "BAD_CENTERING": "Centering offset is wrong",
@@ -64,10 +64,7 @@ class QAFlags:
         return self.names + super().__dir__()
 
     def _upsert_many(self, rows, keys=["name"]):
-        with self.table.db as tx:
-            table = tx[self.table.name]
-            for row in rows:
-                table.upsert(row, keys=keys)
+        upsert_many(self.table.db, self.table.name, rows, keys)
 
     def add(self, exps, *flags, value=1):
         """Add flags to exposures."""
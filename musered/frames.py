@@ -3,6 +3,7 @@ import glob
 import logging
 import os
 from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
 from itertools import product
 from os.path import join
 
@@ -10,7 +11,7 @@ from astropy.io import fits
 from astropy.utils.decorators import lazyproperty
 
 from .settings import STATIC_FRAMES
-from .utils import parse_date
+from .utils import parse_date, read_raw_header
 
 SPECIAL_FRAMES = (
     "OUTPUT_WCS",
@@ -56,6 +57,16 @@ def get_file_from_date(files_dict: dict, date: str) -> str:
     return file
 
 
+def _read_pro_catg(path):
+    """Return the PRO.CATG keyword of a FITS file."""
+    # read only the needed card, except for gzipped files
+    header = read_raw_header(path, ["ESO PRO CATG"])
+    key = header and header["ESO PRO CATG"]
+    if key is None:
+        key = fits.getval(path, "ESO PRO CATG", ext=0)
+    return key
+
+
 class FramesFinder:
     """Handles calibration frames.
 
@@ -78,6 +89,7 @@ class FramesFinder:
         # frames settings
         self.frames = self.conf.get("frames", {})
         self._excludes = {}
+        self._static = {}
 
     @lazyproperty
     def static_files(self):
@@ -87,11 +99,19 @@ class FramesFinder:
     @lazyproperty
     def static_by_catg(self):
         """Dict of static files indexed by PRO.CATG."""
+        files = [
+            f
+            for f in self.static_files
+            if f.endswith((".fits", ".fits.fz", ".fits.gz"))
+        ]
+        paths = [join(self.static_path, f) for f in files]
+        # the header reads are I/O bound, so they are done with threads
+        with ThreadPoolExecutor(max_workers=8) as executor:
+            keys = executor.map(_read_pro_catg, paths)
+
         cat = defaultdict(list)
-        for f in self.static_files:
-            if f.endswith((".fits", ".fits.fz", ".fits.gz")):
-                key = fits.getval(join(self.static_path, f), "ESO PRO CATG", ext=0)
-                cat[key].append(f)
+        for f, key in zip(files, keys):
+            cat[key].append(f)
         return cat
 
     def get_excludes(self, DPR_TYPE=None, column="name"):
@@ -165,6 +185,13 @@ class FramesFinder:
             validity dates are defined in the settings file.
 
         """
+        # the result depends only on the settings and on the static calib
+        # directory, so it is cached for each (catg, date)
+        if (catg, date) not in self._static:
+            self._static[catg, date] = self._find_static(catg, date)
+        return self._static[catg, date]
+
+    def _find_static(self, catg, date=None):
         file = None
         if catg in self.static_conf:
             # if catg is defined in the conf file, try to find a static calib
@@ -1,3 +1,4 @@
+import contextlib
 import datetime
 import fnmatch
 import inspect
@@ -8,7 +9,7 @@ import os
 import shutil
 from collections import defaultdict
 from glob import glob, iglob
-from os.path import join
+from os.path import basename, join
 
 import numpy as np
 from astropy.io import fits
@@ -26,12 +27,13 @@ from .reporter import Reporter
 from .utils import (
     dict_values,
     ensure_list,
+    iter_fits_files,
+    iter_raw_keywords,
     load_db,
     load_table,
     load_yaml_config,
     parse_gto_db,
     parse_qc_keywords,
-    parse_raw_keywords,
     parse_weather_conditions,
     upsert_many,
 )
@@ -109,6 +111,11 @@ class MuseRed(Reporter):
         """The SQLAlchemy columns object for the raw table."""
         return self.raw.table.c
 
+    @lazyproperty
+    def raw_count(self):
+        """Return the number of files in the raw table."""
+        return self.raw.count()
+
     @lazyproperty
     def nights(self):
         """Return the list of nights for which data is available."""
@@ -374,53 +381,92 @@ class MuseRed(Reporter):
                 "be a dict or True to exclude all flags"
             )
 
-    def update_db(self, force=False):
-        """Create or update the database containing FITS keywords."""
+    def update_db(self, force=False, n_jobs=1):
+        """Create or update the database containing FITS keywords.
+
+        Parameters
+        ----------
+        force : bool
+            If True, parse again the files that are already in the database.
+        n_jobs : int
+            Number of parallel processes used to read the FITS headers.
 
-        # Already parsed raw files
+        """
+
+        # Already parsed raw files, as a set for fast lookups
         known_files = (
-            self.select_column("filename") if "filename" in self.raw.columns else []
+            set(self.select_column("filename"))
+            if "filename" in self.raw.columns
+            else set()
         )
 
-        # Get the list of FITS files in the raw directory
+        # Get the list of FITS files in the raw directory, filtering the known
+        # files while scanning the directories
         nskip = 0
         flist = []
-        for root, dirs, files in os.walk(self.raw_path):
-            if root.endswith(".cache"):
-                # skip the cache directory
-                self.logger.debug("skipping %s", root)
-                continue
-            for f in files:
-                if f.endswith((".fits", ".fits.fz")):
-                    if f in known_files:
-                        nskip += 1
-                        if not force:
-                            continue
-                    flist.append(join(root, f))
+        for path in iter_fits_files(self.raw_path):
+            if basename(path) in known_files:
+                nskip += 1
+                if not force:
+                    continue
+            flist.append(path)
 
         self.logger.info("%d new FITS files, %d known", len(flist), nskip)
 
         # Parse FITS headers to get the keyword values
-        rows = parse_raw_keywords(
+        rows = iter_raw_keywords(
             flist,
             self.datasets,
             runs=self.conf.get("runs"),
             additional_keywords=self.conf.get("additional_keywords"),
+            n_jobs=n_jobs,
         )
 
+        # Insert the rows by chunks, with one transaction per chunk, to limit
+        # the memory usage and to save the parsed rows if interrupted. With
+        # force the table is emptied and filled in a single transaction, so
+        # that it is left unchanged if the parsing fails or is interrupted.
+        nrows = 0
+        chunk = []
+        chunk_size = 500
+        with self.db if force else contextlib.nullcontext():
+            if force:
+                self.raw.delete()
+            try:
+                for row in rows:
+                    chunk.append(row)
+                    if len(chunk) == chunk_size:
+                        with self.db as tx:
+                            tx["raw"].insert_many(chunk)
+                        nrows += len(chunk)
+                        chunk = []
+            except KeyboardInterrupt:
+                if force:
+                    self.logger.warning("interrupted, raw table left unchanged")
+                else:
+                    self.logger.warning("interrupted, saving the parsed rows")
+                raise
+            finally:
+                # the last rows, or the rows parsed before an interruption
+                if chunk and not force:
+                    with self.db as tx:
+                        tx["raw"].insert_many(chunk)
+                    nrows += len(chunk)
+                    chunk = []
+            if chunk:
+                with self.db as tx:
+                    tx["raw"].insert_many(chunk)
+                nrows += len(chunk)
+
+        if force:
+            self.logger.info("updated %d rows", nrows)
+        else:
+            self.logger.info("inserted %d rows, skipped %d", nrows, nskip)
+
         with self.db as tx:
             raw = tx["raw"]
             reduced = tx[self.reduced.name]
 
-            # Insert or update lines in the raw table
-            if force:
-                raw.delete()
-                raw.insert_many(rows)
-                self.logger.info("updated %d rows", len(rows))
-            else:
-                raw.insert_many(rows)
-                self.logger.info("inserted %d rows, skipped %d", len(rows), nskip)
-
             # Create indexes if needed
             for name in ("night", "name", "DATE_OBS", "DPR_TYPE"):
                 if not raw.has_index([name]):
@@ -441,7 +487,7 @@ class MuseRed(Reporter):
             parse_gto_db(self.db, self.conf["GTO_logs"]["db"])
 
         # Cleanup cached attributes
-        del self.nights, self.runs, self.exposures
+        del self.raw_count, self.nights, self.runs, self.exposures
 
     def update_qc(self, dpr_types=None, recipe_name=None, force=False):
         """Create or update the tables containing QC keywords."""
@@ -843,6 +889,7 @@ class MuseRed(Reporter):
 
             date_list = []
             tbl = self.get_table(table).table
+            known_dates = set(alldates)
             for date in dates:
                 if date in self.runs:
                     where = tbl.c.run == date
@@ -868,7 +915,7 @@ class MuseRed(Reporter):
                             d, DPR_TYPE=DPR_TYPE, column=datecol
                         )
                         date_list += d
-                elif date in alldates:
+                elif date in known_dates:
                     date_list.append(date)
                 elif "*" in date:
                     date_list += fnmatch.filter(alldates, date)
@@ -12,7 +12,7 @@ from astropy.table import Column, Table
 from mpdaf.log import clear_loggers
 from mpdaf.MUSE import MoffatModel2
 
-from ..utils import get_exp_name
+from ..utils import get_exp_name, write_fits_table
 from .recipe import PythonRecipe
 
 try:
@@ -79,7 +79,7 @@ def do_fsf(
                 vtab.add_row(
                     [b, lb, pfwhm, pbeta, ifwhm, ibeta, ifwhm - pfwhm, ibeta - pbeta]
                 )
-            vtab.write(outputfile2, overwrite=True)
+            write_fits_table(vtab, outputfile2)
         # computing convolution kernel
         imphot_fwhms = tab[[e["filter"] in filters[0] for e in tab]]["fwhm"]
         psfrec_fwhms = fsfmodel.get_fwhm(np.array(filters[1]))
@@ -195,7 +195,7 @@ def do_fsf(
         row.append(val)
     tab.add_row(row)
 
-    tab.write(outputfile1, overwrite=True)
+    write_fits_table(tab, outputfile1)
 
 
 class FSF(PythonRecipe):
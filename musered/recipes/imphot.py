@@ -26,7 +26,7 @@ from astropy.table import Table, vstack
 from joblib import Parallel, delayed
 from mpdaf.obj import Cube, Image
 
-from ..utils import get_exp_name
+from ..utils import get_exp_name, write_fits_table
 from .recipe import PythonRecipe
 
 # List the subset of the HST WFC filters that both significantly
@@ -252,7 +252,7 @@ def _process_exp(i, nfiles, filename, output_dir, param):
     t.meta["DEC_OFF"] = ddec
     t.meta["DATE-OBS"] = hdr["DATE-OBS"]
     t.meta["MJD-OBS"] = hdr["MJD-OBS"]
-    t.write(join(outdir, "IMPHOT.fits"), overwrite=True)
+    write_fits_table(t, join(outdir, "IMPHOT.fits"))
 
     return hdr["DATE-OBS"], hdr["MJD-OBS"], dra, ddec
 
@@ -334,6 +334,6 @@ class IMPHOT(PythonRecipe):
             t = vstack([off, t])
 
         self.logger.info("Save OFFSET_LIST file: %s", outname)
-        t.write(outname, overwrite=True)
+        write_fits_table(t, outname)
 
         return outname
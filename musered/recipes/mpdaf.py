@@ -10,7 +10,7 @@ from astropy.io import fits
 from astropy.table import Table
 from mpdaf.obj import CubeList, CubeMosaic
 
-from ..utils import get_exp_name, make_band_images
+from ..utils import get_exp_name, make_band_images, write_fits_table
 from .recipe import PythonRecipe
 
 try:
@@ -120,7 +120,7 @@ def do_combine(
         rej.write(rejmap_name)
     if all([stat, stat_name]):
         logger.info("Saving stats: %s", stat_name)
-        stat.write(stat_name, format="fits", overwrite=True)
+        write_fits_table(stat, stat_name)
 
 
 def do_combine_fsf(fsf_tables):
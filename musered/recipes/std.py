@@ -22,7 +22,9 @@ def combine_std_median(
 
     resp, err = [], []
     for stdf in flist:
-        std = Table.read(stdf)
+        # reading the table dominates the time spent here, so the data is
+        # read without creating a Table
+        std = fits.getdata(stdf, 1, memmap=False)
         resp.append(np.interp(lb, std["lambda"], std[colname]))
         err.append(np.interp(lb, std["lambda"], std[errname]))
 
@@ -15,7 +15,7 @@ from astropy.table import Table
 from mpdaf.obj import Cube, CubeList
 
 from ..masking import mask_sources
-from ..utils import make_band_images
+from ..utils import make_band_images, write_fits_table
 from .recipe import PythonRecipe
 from .science import SCIPOST
 
@@ -192,7 +192,7 @@ class SUPERFLAT(PythonRecipe):
         supercube.write(join(outdir, "DATACUBE_SUPERFLAT.fits.gz"), savemask="nan")
         expmap.write(join(outdir, "DATACUBE_EXPMAP.fits.gz"), savemask="nan")
         expim.write(join(outdir, "IMAGE_EXPMAP.fits"), savemask="nan")
-        stat.write(join(outdir, "STATPIX.fits"), overwrite=True)
+        write_fits_table(stat, join(outdir, "STATPIX.fits"))
         superim.write(join(outdir, "IMAGE_SUPERFLAT.fits"), savemask="nan")
 
         # 3. Subtract superflat
@@ -1,9 +1,9 @@
+import importlib.util
 import json
 import os
 import re
-import textwrap
 from collections import defaultdict
-from glob import iglob
+from functools import lru_cache
 
 import click
 import matplotlib.pyplot as plt
@@ -11,20 +11,58 @@ import numpy as np
 from astropy.io import fits
 from astropy.table import Table
 from mpdaf.obj import Cube, Image
+from mpdaf.obj.objs import bounding_box
 from sqlalchemy import sql
 
 from .recipes import normalize_recipe_name, recipe_classes
-from .utils import get_exp_name, query_count_to_table
+from .utils import (
+    ensure_list,
+    find_files,
+    get_exp_name,
+    query_count_by_category,
+    query_count_to_table,
+)
 
-try:
-    from IPython.display import display, HTML
-except ImportError:
-    IPYTHON = False
-else:
-    IPYTHON = True
+# IPython is slow to import, so it is imported only by HTMLFormatter
+IPYTHON = importlib.util.find_spec("IPython") is not None
 
 FILTER_KEY = "ESO DRS MUSE FILTER NAME"
 
+RECIPE_TEMPLATE = """\
+- date    : {date_run}
+- log     : {log_file}
+- json    : {recipe_file}
+- frames  : {frames}
+- path    : {path}
+- runtime : {usert:.1f} (user) {syst:.1f} (sys)"""
+
+
+def _zoom_image(im, center, size):
+    """Extract a subimage, reading only the needed pixels from the file.
+
+    Images are loaded lazily by MPDAF, but `mpdaf.obj.Image.subimage` reads
+    the full data array when the region is clipped by the image edges. So the
+    region is first sliced from the image, which reads only these pixels, and
+    the subimage is then extracted from this slice.
+
+    """
+    center = np.asarray(center, dtype=float)
+    radius = np.broadcast_to(np.asarray(size, dtype=float) / 2, (2,))
+    [sy, sx], _, _ = bounding_box(
+        form="rectangle", center=center, radii=radius, shape=im.shape
+    )
+    if sy.start < sy.stop and sx.start < sx.stop:
+        im = im[sy, sx]
+        center = center - [sy.start, sx.start]
+    return im.subimage(center, size, unit_center=None, unit_size=None)
+
+
+@lru_cache(maxsize=1024)
+def _load_recipe_json(path, mtime):
+    """Load a recipe JSON file, the cache is invalidated when mtime changes."""
+    with open(path) as f:
+        return json.load(f)
+
 
 class TextFormatter:
     show_title = print
@@ -37,16 +75,22 @@ class TextFormatter:
 
 
 class HTMLFormatter:
+    def __init__(self):
+        from IPython.display import display, HTML
+
+        self.display = display
+        self.HTML = HTML
+
     def show_title(self, text):
-        display(HTML(f"<h2>{text}</h2>"))
+        self.display(self.HTML(f"<h2>{text}</h2>"))
 
     def show_text(self, text):
-        display(HTML(f"<p>{text}</p>"))
+        self.display(self.HTML(f"<p>{text}</p>"))
 
     def show_table(self, t, **kwargs):
         if t is not None:
             kwargs.setdefault("max_width", -1)
-            display(HTML(t._base_repr_(html=True, **kwargs)))
+            self.display(self.HTML(t._base_repr_(html=True, **kwargs)))
 
 
 class Reporter:
@@ -56,6 +100,8 @@ class Reporter:
         self.fmt = (
             HTMLFormatter if self.format == "html" and IPYTHON else TextFormatter
         )()
+        # figures created by show_images, indexed by (nrows, ncols, figsize)
+        self._figures = {}
 
     def list_datasets(self):
         """Print the list of datasets."""
@@ -115,22 +161,21 @@ class Reporter:
 
         if header:
             self.fmt.show_text(f"Reduction version {self.version}")
-            self.fmt.show_text(f"{self.raw.count()} files\n")
+            self.fmt.show_text(f"{self.raw_count} files\n")
             self.list_datasets()
             print()
             self.list_runs()
 
-        if len(self.raw) == 0:
+        if self.raw_count == 0:
             self.fmt.show_text("Nothing yet.")
             return
 
-        redc = self.reduced.table.c
         exclude_names = self.frames.get_excludes() if filter_excludes else None
 
         # count files per night and per type, raw data, then reduced
         if "raw" in show_tables:
             self.fmt.show_title(f"\nRaw data:\n")
-            if len(self.raw) == 0:
+            if self.raw_count == 0:
                 self.fmt.show_text("Nothing yet.")
             else:
                 # uninteresting objects to exclude from the report
@@ -156,31 +201,32 @@ class Reporter:
                 self.fmt.show_text("Nothing yet.")
             return
 
+        # count calib (per night) and science (per exposure) with one query
+        datecols = {}
+        if "calib" in show_tables:
+            datecols["CALIB"] = "night"
+        if "science" in show_tables:
+            datecols["SCIENCE"] = "name"
+        if not datecols:
+            return
+
+        tables = query_count_by_category(
+            self.reduced,
+            datecols,
+            date_list=date_list,
+            run=run,
+            exclude_names=exclude_names,
+        )
+
         if "calib" in show_tables:
             self.fmt.show_title(f"\nProcessed calib data:\n")
-            t = query_count_to_table(
-                self.reduced,
-                date_list=date_list,
-                run=run,
-                exclude_names=exclude_names,
-                datecol="night",
-                countcol="recipe_name",
-                where=redc.DPR_CATG == "CALIB",
-            )
+            t = tables["CALIB"]
             if t:
                 self.fmt.show_table(t)
 
         if "science" in show_tables:
             self.fmt.show_title(f"\nProcessed science data:\n")
-            t = query_count_to_table(
-                self.reduced,
-                where=redc.DPR_CATG == "SCIENCE",
-                date_list=date_list,
-                run=run,
-                exclude_names=exclude_names,
-                datecol="name",
-                countcol="recipe_name",
-            )
+            t = tables["SCIENCE"]
             if t:
                 self.fmt.show_table(t)
 
@@ -189,11 +235,30 @@ class Reporter:
         if recipes:
             recipes = [normalize_recipe_name(name) for name in recipes]
 
+        # select only the displayed columns instead of the full rows
+        redc = self.reduced.table.c
+        cols = (
+            "recipe_name",
+            "DPR_TYPE",
+            "night",
+            "date_run",
+            "log_file",
+            "recipe_file",
+            "path",
+            "user_time",
+            "sys_time",
+            "nbwarn",
+        )
+        wc = redc.name == expname
+        if recipes:
+            wc &= redc.recipe_name.in_(recipes)
+        query = sql.select(
+            [redc[col] for col in cols if col in redc], whereclause=wc
+        ).order_by(redc.id)
+
         res = defaultdict(list)
-        for r in self.reduced.find(name=expname):
-            if recipes and r["recipe_name"] not in recipes:
-                continue
-            res[r["recipe_name"]].append(r)
+        for r in self.execute(query):
+            res[r["recipe_name"]].append(dict(r.items()))
 
         res = list(res.values())
         res.sort(key=lambda x: x[0]["date_run"])
@@ -234,18 +299,7 @@ class Reporter:
             usert = o.get("user_time") or 0
             syst = o.get("sys_time") or 0
             click.secho(f"★ Recipe: {o['recipe_name']}", fg="green", bold=True)
-            print(
-                textwrap.dedent(
-                    f"""\
-            - date    : {o['date_run']}
-            - log     : {o['log_file']}
-            - json    : {o['recipe_file']}
-            - frames  : {frames}
-            - path    : {o['path']}
-            - runtime : {usert:.1f} (user) {syst:.1f} (sys)\
-            """
-                )
-            )
+            print(RECIPE_TEMPLATE.format(frames=frames, usert=usert, syst=syst, **o))
             if o["nbwarn"] > 0:
                 click.secho(f"- warning : {o['nbwarn']}", fg="red", bold=True)
             # else:
@@ -255,8 +309,9 @@ class Reporter:
                 continue
 
             if full and os.path.isfile(o["recipe_file"]):
-                with open(o["recipe_file"]) as f:
-                    info = json.load(f)
+                info = _load_recipe_json(
+                    o["recipe_file"], os.path.getmtime(o["recipe_file"])
+                )
 
                 for name in ("calib", "raw"):
                     if name not in info or not info[name]:
@@ -274,34 +329,43 @@ class Reporter:
     def info_raw(self, **kwargs):
         """Print information about raw exposures for a given night or type."""
 
-        rows = list(self.raw.find(**kwargs))
-        if len(rows) == 0:
+        cols = [
+            "name",
+            "EXPTIME",
+            "OBJECT",
+            # 'DPR_CATG', 'DPR_TYPE',
+            "INS_DROT_POSANG",
+            "INS_MODE",
+            "INS_TEMP7_VAL",
+            "OBS_NAME",
+            "OCS_SGS_AG_FWHMX_MED",  # 'OCS_SGS_AG_FWHMY_MED',
+            "OCS_SGS_FWHM_MED",  # 'OCS_SGS_FWHM_RMS',
+            "TEL_AIRM_END",
+            "TEL_AIRM_START",
+            "TPL_START",
+        ]
+
+        # select only the displayed columns instead of the full rows
+        rawc = self.raw.table.c
+        columns = [[] for _ in cols]
+        if all(key in rawc for key in kwargs):
+            wc = [rawc[key].in_(ensure_list(val)) for key, val in kwargs.items()]
+            query = sql.select(
+                [rawc[col] for col in cols], whereclause=sql.and_(*wc)
+            ).order_by(rawc.name)
+            # fill the columns while iterating on the results, instead of
+            # fetching all the rows first
+            for row in self.execute(query):
+                for column, val in zip(columns, row):
+                    column.append(val)
+
+        if len(columns[0]) == 0:
             self.logger.error("Could not find exposures")
             return
 
-        t = Table(rows=rows, names=rows[0].keys())
-        t.keep_columns(
-            [
-                "name",
-                "EXPTIME",
-                "OBJECT",
-                "TPL_START",
-                # 'DPR_CATG', 'DPR_TYPE',
-                "INS_DROT_POSANG",
-                "INS_MODE",
-                "INS_TEMP7_VAL",
-                "OCS_SGS_AG_FWHMX_MED",  # 'OCS_SGS_AG_FWHMY_MED',
-                "OCS_SGS_FWHM_MED",  # 'OCS_SGS_FWHM_RMS',
-                "TEL_AIRM_END",
-                "TEL_AIRM_START",
-                "OBS_NAME",
-            ]
-        )
-        for col in list(t.columns.values()):
-            col.name = (
-                col.name.replace("TEL_", "").replace("OCS_SGS_", "").replace("INS_", "")
-            )
-        t.sort("name")
+        # shorten column names
+        names = [re.sub(r"^(TEL|OCS_SGS|INS)_", "", col) for col in cols]
+        t = Table(columns, names=names)
         self.fmt.show_table(t, max_width=-1)
 
     def info_qc(self, dpr_type, date_list=None, **kwargs):
@@ -405,6 +469,7 @@ class Reporter:
         catalog=None,
         zoom_center=None,
         zoom_size=None,
+        reuse_figure=False,
         **kwargs,
     ):
         """Show images on a grid.
@@ -433,6 +498,9 @@ class Reporter:
             Position (in pixels) on which to zoom in.
         zoom_size : (float, float)
             Size (in pixels) of the zoom.
+        reuse_figure : bool
+            If True, reuse the figure created by a previous call with the same
+            grid, instead of creating a new one.
         **kwargs
             Additional parameters are passed to `mpdaf.obj.Image.plot`.
 
@@ -451,20 +519,31 @@ class Reporter:
             skycoords = np.array([tbl["dec"], tbl["ra"]])
 
         nrows = int(np.ceil(len(imgs) / ncols))
-        fig, axes = plt.subplots(
-            nrows,
-            ncols,
-            sharex=True,
-            sharey=True,
-            figsize=(figsize * ncols, figsize * nrows),
-            gridspec_kw={"wspace": 0, "hspace": 0},
-        )
+        key = (nrows, ncols, figsize)
+        # the figure may have been closed since the previous call
+        fig, axes = self._figures.get(key, (None, None))
+        if reuse_figure and fig is not None and plt.fignum_exists(fig.number):
+            for ax in fig.axes:
+                if ax not in axes.flat:
+                    # remove additional axes, e.g. colorbars
+                    ax.remove()
+            for ax in axes.flat:
+                ax.cla()
+        else:
+            fig, axes = plt.subplots(
+                nrows,
+                ncols,
+                sharex=True,
+                sharey=True,
+                figsize=(figsize * ncols, figsize * nrows),
+                gridspec_kw={"wspace": 0, "hspace": 0},
+            )
+            if reuse_figure:
+                self._figures[key] = (fig, axes)
 
         for im, ax in zip(imgs, axes.flat):
             if zoom_size is not None and zoom_center is not None:
-                im = im.subimage(
-                    zoom_center, zoom_size, unit_center=None, unit_size=None
-                )
+                im = _zoom_image(im, zoom_center, zoom_size)
             im.plot(ax=ax, **kwargs)
             filtr = im.primary_header[FILTER_KEY]
             title = get_exp_name(im.filename)
@@ -538,15 +617,25 @@ class Reporter:
 
         filters = [filt] if isinstance(filt, str) else filt
 
+        if filters and self.conf.get("filter_in_filename", False):
+            # select the files by their name, without reading the headers
+            suffixes = tuple(f"{sep}{f}.fits" for f in filters for sep in "_-")
+        else:
+            suffixes = None
+
         imgs = []
         for r in res:
-            for f in iglob(f"{r['path']}/{DPR_TYPE}*.fits"):
-                try:
-                    filtr = fits.getval(f, FILTER_KEY)
-                except KeyError:
-                    filtr = None
-                if filtr and filters and filtr not in filters:
-                    continue
+            for f in find_files(r["path"], DPR_TYPE):
+                if suffixes is not None:
+                    if not f.endswith(suffixes):
+                        continue
+                elif filters:
+                    try:
+                        filtr = fits.getval(f, FILTER_KEY)
+                    except KeyError:
+                        filtr = None
+                    if filtr and filtr not in filters:
+                        continue
                 im = Image(f, convert_float64=False)
                 imgs.append(im)
 
@@ -1,13 +1,93 @@
+import contextlib
 import inspect
+import json
 import logging
 import os
 import sys
+import time
 from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
 
 import click
-from astropy.io import fits
+from joblib import Parallel, delayed
+from sqlalchemy import sql
 
-from musered.utils import upsert_many
+from musered.utils import upsert_many, verify_fits_checksum
+
+
+def _load_session(eso, filename, username=None):
+    """Restore the ESO authentication saved by a previous run.
+
+    Returns True if the saved token is still valid for ``username``, in which
+    case the login (and password prompt) can be skipped.
+
+    """
+    logger = logging.getLogger(__name__)
+    if not os.path.isfile(filename):
+        return False
+    try:
+        with open(filename) as f:
+            session = json.load(f)
+        if username is not None and session["username"] != username:
+            return False
+        # keep a margin of 10 minutes, as astroquery does
+        if session["expiration_time"] is None or (
+            time.time() > session["expiration_time"] - 600
+        ):
+            return False
+
+        # AuthInfo is private to astroquery, so discard the saved session if
+        # it cannot be restored with the installed version
+        from astroquery.eso.core import AuthInfo
+
+        auth = AuthInfo.__new__(AuthInfo)
+        auth.username = session["username"]
+        auth.password = None
+        auth.token = session["token"]
+        auth.expiration_time = session["expiration_time"]
+        auth.expired()  # check that the restored object is usable
+        eso._auth_info = auth
+        eso._session.cookies.update(session["cookies"])
+    except Exception as e:
+        logger.debug("Discarding the saved ESO session: %s", e)
+        eso._auth_info = None
+        with contextlib.suppress(OSError):
+            os.remove(filename)
+        return False
+
+    logger.info("Reusing the ESO session of %s", session["username"])
+    return True
+
+
+def _save_session(eso, filename):
+    """Save the ESO authentication token (not the password) for later runs."""
+    auth = getattr(eso, "_auth_info", None)
+    if auth is None:
+        return
+    session = {
+        "username": auth.username,
+        "token": auth.token,
+        "expiration_time": auth.expiration_time,
+        "cookies": eso._session.cookies.get_dict(),
+    }
+    fd = os.open(filename, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+    with open(fd, "w") as f:
+        json.dump(session, f)
+
+
+def _copy_session(eso):
+    """Return a new ESO query instance, sharing the authentication of ``eso``.
+
+    The instances and their requests sessions are not thread-safe, so this is
+    used to run queries concurrently.
+
+    """
+    new = type(eso)()
+    new.cache_location = eso.cache_location
+    new.ROW_LIMIT = eso.ROW_LIMIT
+    new._auth_info = getattr(eso, "_auth_info", None)
+    new._session.cookies.update(eso._session.cookies)
+    return new
 
 
 @click.argument("dataset", nargs=-1)
@@ -69,22 +149,28 @@ def retrieve_data(
 
     from astroquery.eso import Eso
 
+    # customize astroquery's cache location, to have it on the same device
+    # as the final path. This is also where the query form used by
+    # --help-query is cached, so it is fetched only once.
+    Eso.cache_location = os.path.join(mr.raw_path, ".cache")
+    os.makedirs(Eso.cache_location, exist_ok=True)
+
     if help_query:
         Eso.query_instrument("muse", help=True)
         return
 
-    Eso.login(**params)
+    session_file = os.path.join(Eso.cache_location, "eso_session.json")
+    if not _load_session(Eso, session_file, params.get("username")):
+        Eso.login(**params)
+        _save_session(Eso, session_file)
 
     Eso.ROW_LIMIT = -1
 
-    # customize astroquery's cache location, to have it on the same device
-    # as the final path
-    Eso.cache_location = os.path.join(mr.raw_path, ".cache")
-    os.makedirs(Eso.cache_location, exist_ok=True)
-
     if calib:
         dataset = calib.split(",")
 
+    # prepare the query filters for all datasets
+    queries = []
     for ds in dataset:
         if calib:
             ds = ds.replace("-", " ")
@@ -105,11 +191,26 @@ def retrieve_data(
 
         logger.info("Searching files for %s", ds)
         logger.info("Filters: %s", column_filters)
-        table = Eso.query_instrument("muse", cache=False, column_filters=column_filters)
+        queries.append((ds, column_filters))
+
+    # the ESO query form does not allow to combine the filters of several
+    # datasets, so the queries are run concurrently, each with its own
+    # instance and requests session
+    def query(column_filters):
+        eso = _copy_session(Eso)
+        return eso.query_instrument("muse", cache=False, column_filters=column_filters)
+
+    with ThreadPoolExecutor(max_workers=4) as executor:
+        tables = list(executor.map(query, [filt for _, filt in queries]))
+
+    # files to retrieve, for all datasets
+    dpids = []
+
+    for (ds, _), table in zip(queries, tables):
         if table is None:
-            logger.warning("Found nothing")
+            logger.warning("Found nothing for %s", ds)
             continue
-        logger.info("Found %d files", len(table))
+        logger.info("Found %d files for %s", len(table), ds)
         table.keep_columns(
             [
                 "Object",
@@ -126,24 +227,38 @@ def retrieve_data(
             ]
         )
         print(table)
-        if not dry_run:
-            kw = dict(destination=mr.raw_path)
-            if not calib:
-                kw["with_calib"] = "raw"
-                sig = inspect.signature(Eso.retrieve_data)
-                if "request_all_objects" in sig.parameters:
-                    kw["request_all_objects"] = force
-            Eso.retrieve_data(table["DP.ID"], **kw)
+        dpids.extend(table["DP.ID"])
+
+    # retrieve the files for all datasets with a single request, removing
+    # duplicates if some files are found for several datasets
+    if not dry_run and dpids:
+        kw = dict(destination=mr.raw_path)
+        if not calib:
+            kw["with_calib"] = "raw"
+            sig = inspect.signature(Eso.retrieve_data)
+            if "request_all_objects" in sig.parameters:
+                kw["request_all_objects"] = force
+        Eso.retrieve_data(list(dict.fromkeys(dpids)), **kw)
 
     if not dry_run and not no_update_db:
         mr.update_db()
 
 
+def _verify_checksum(path):
+    """Verify the checksums of a file, None if invalid or not readable."""
+    try:
+        return verify_fits_checksum(path)
+    except OSError:
+        return None
+
+
 @click.option("--report", is_flag=True, help="report integrity checks")
+@click.option("--njobs", default=1, help="number of parallel process")
 @click.pass_obj
-def check_integrity(mr, report):
+def check_integrity(mr, report, njobs):
     """Test raw files checksum."""
     checksum_col = "valid_checksum"
+    mtime_col = "checksum_mtime"
 
     if report:
         if checksum_col not in mr.raw.columns:
@@ -160,22 +275,48 @@ def check_integrity(mr, report):
             print("\n".join(o["path"] for o in mr.raw.find(valid_checksum=False)))
         return
 
-    kw = {checksum_col: None} if checksum_col in mr.raw.columns else {}
-    nrows = mr.raw.count(**kw)
+    # verify the files which were not verified yet, or which were modified
+    # since their verification
+    # select only the needed columns, the checksum columns may not exist yet
+    c = mr.raw.table.c
+    query = sql.select(
+        [c[col] for col in ("id", "path", checksum_col, mtime_col) if col in c]
+    )
+    files = []
     rows = []
+    for row in map(dict, mr.execute(query)):
+        verified = row.get(checksum_col) is not None
+        if verified and row.get(mtime_col) is None:
+            # verified before the modification time was stored, or missing
+            continue
+        try:
+            mtime = os.path.getmtime(row["path"])
+        except OSError:
+            print(f"{row['path']} : MISSING")
+            rows.append({"id": row["id"], checksum_col: False, mtime_col: None})
+            continue
+        if verified and mtime == row[mtime_col]:
+            continue
+        files.append((row["id"], row["path"], mtime))
+
+    nrows = len(files)
+    paths = [path for _, path, _ in files]
+    # the files are verified sequentially if njobs=1, and the results are
+    # consumed as they arrive to be able to save them on interruption
+    parallel = Parallel(n_jobs=njobs, batch_size=8, return_as="generator")
+    results = parallel(delayed(_verify_checksum)(path) for path in paths)
     try:
-        for i, row in enumerate(mr.raw.find(**kw), start=1):
-            with fits.open(row["path"], checksum=True) as hdul:
-                for hdu in hdul:
-                    if not hdu._checksum_valid or not hdu._datasum_valid:
-                        print(f"{i}/{nrows} : {row['path']} : INVALID")
-                        rows.append({"id": row["id"], checksum_col: False})
-                        break
-                else:
-                    nhdus = len(hdul)
-                    print(f"{i}/{nrows} : {row['path']} : {nhdus} valid HDUs")
-                    rows.append({"id": row["id"], checksum_col: True})
+        # results is the first iterable of zip, so that the generator is
+        # exhausted, otherwise joblib warns about cancelled tasks
+        for i, (nhdus, (id_, path, mtime)) in enumerate(zip(results, files), start=1):
+            if nhdus is None:
+                print(f"{i}/{nrows} : {path} : INVALID")
+            else:
+                print(f"{i}/{nrows} : {path} : {nhdus} valid HDUs")
+            rows.append({"id": id_, checksum_col: nhdus is not None, mtime_col: mtime})
     except KeyboardInterrupt:
         print("Saving results before exit...")
+        # cancel the pending tasks and stop the workers
+        results.close()
 
     upsert_many(mr.db, "raw", rows, ["id"])
@@ -1,14 +1,22 @@
-import itertools
 import logging
 import pprint
+from functools import partial
 
 import click
 import numpy as np
+from astropy.io import fits
 from astropy.table import Table
+from joblib import Parallel, delayed
+from sqlalchemy import sql
 
 from musered.recipes import normalize_recipe_name
 from musered.utils import upsert_many
 
+try:
+    import fitsio
+except ImportError:
+    fitsio = None
+
 logger = logging.getLogger(__name__)
 
 
@@ -36,89 +44,118 @@ logger = logging.getLogger(__name__)
 )
 @click.option("--force", is_flag=True, help="force update of database")
 @click.option("--dry-run", is_flag=True, help="don't update the database")
+@click.option("--njobs", default=1, help="number of parallel process")
 @click.pass_obj
-def update_qa(mr, date, sky, fsf, sparta, imphot, psfrec, recipe, band, force, dry_run):
+def update_qa(
+    mr, date, sky, fsf, sparta, imphot, psfrec, recipe, band, force, dry_run, njobs
+):
     """Update QA databases (qa_raw and qa_reduced)."""
 
-    if len(date) == 0:
-        dates = list(itertools.chain.from_iterable(mr.exposures.values()))
-    else:
-        dates = mr.prepare_dates(date, "OBJECT", "name")
+    # without dates, all the valid exposures are processed
+    dates = date or None
 
-    kwargs = dict(dates=dates, skip=not force, dry_run=dry_run)
+    kwargs = dict(dates=dates, skip=not force, dry_run=dry_run, njobs=njobs)
+
+    # find the exposures already processed for all the requested QA values,
+    # with one query per table
+    exists = {}
+    if not force:
+        for table, keys in (
+            (mr.qa_reduced, [("skyB", sky), ("IM_vers", imphot), ("FSF_FWHM_B", fsf)]),
+            (mr.qa_raw, [("SP_See", sparta), ("PR_vers", psfrec)]),
+        ):
+            keys = [key for key, selected in keys if selected]
+            if keys:
+                exists.update(_find_existing_exps(table, keys))
 
     if sky:
-        qa_sky(mr, recipe_name=recipe, **kwargs)
-    if sparta:
-        qa_sparta(mr, **kwargs)
-    if psfrec:
-        qa_psfrec(mr, **kwargs)
+        qa_sky(mr, recipe_name=recipe, exists=exists.get("skyB"), **kwargs)
+    if sparta and psfrec:
+        qa_sparta_psfrec(mr, exists=exists or None, **kwargs)
+    elif sparta:
+        qa_sparta(mr, exists=exists.get("SP_See"), **kwargs)
+    elif psfrec:
+        qa_psfrec(mr, exists=exists.get("PR_vers"), **kwargs)
     if imphot:
-        qa_imphot(mr, recipe_name=recipe, band=band, **kwargs)
+        qa_imphot(
+            mr, recipe_name=recipe, band=band, exists=exists.get("IM_vers"), **kwargs
+        )
     if fsf:
-        qa_fsf(mr, recipe_name=recipe, **kwargs)
-
-
-def qa_imphot(mr, recipe_name=None, dates=None, skip=True, dry_run=False, band="F775W"):
+        qa_fsf(mr, recipe_name=recipe, exists=exists.get("FSF_FWHM_B"), **kwargs)
+
+
+def qa_imphot(
+    mr,
+    recipe_name=None,
+    dates=None,
+    skip=True,
+    dry_run=False,
+    band="F775W",
+    njobs=1,
+    exists=None,
+):
     if recipe_name is None:
         recipe_name = "imphot"
-    dates = mr.prepare_dates(dates, DPR_TYPE='OBJECT')
-    rows = list(mr.reduced.find(recipe_name=recipe_name, DPR_TYPE="IMPHOT", name=dates))
-    if skip:
+    if not skip:
+        exists = set()
+    elif exists is None:
         exists = _find_existing_exp(mr.qa_reduced, "IM_vers")
-        rows = [row for row in rows if row["name"] not in exists]
+    rows = _find_exp_rows(
+        mr,
+        mr.reduced,
+        dates,
+        exclude=exists,
+        recipe_name=recipe_name,
+        DPR_TYPE="IMPHOT",
+    )
     logger.info(f"imphot: found {len(rows)} exposures in database to process")
-    qarows = []
-    for row in rows:
-        imphot = _imphot(f"{row['path']}/IMPHOT.fits", band=band)
-        imphot["IM_vers"] = row["recipe_version"]
-        logger.debug("Name %s Imphot %s", row["name"], imphot)
-        qarows.append({"name": row["name"], **imphot})
+    qarows = _process_rows(partial(_imphot_row, band=band), rows, njobs)
     if dry_run:
         pprint.pprint(qarows)
     else:
         upsert_many(mr.db, mr.qa_reduced.name, qarows, ["name"])
 
 
-def qa_sky(mr, recipe_name=None, dates=None, skip=True, dry_run=False):
+def qa_sky(
+    mr, recipe_name=None, dates=None, skip=True, dry_run=False, njobs=1, exists=None
+):
     if recipe_name is None:
         recipe_name = "muse_scipost"
-    dates = mr.prepare_dates(dates, DPR_TYPE='OBJECT')
     recipe_name = normalize_recipe_name(recipe_name)
-    rows = list(
-        mr.reduced.find(recipe_name=recipe_name, DPR_TYPE="SKY_SPECTRUM", name=dates)
-    )
-    if skip:
+    if not skip:
+        exists = set()
+    elif exists is None:
         exists = _find_existing_exp(mr.qa_reduced, "skyB")
-        rows = [row for row in rows if row["name"] not in exists]
+    rows = _find_exp_rows(
+        mr,
+        mr.reduced,
+        dates,
+        exclude=exists,
+        recipe_name=recipe_name,
+        DPR_TYPE="SKY_SPECTRUM",
+    )
     logger.info(f"sky: found {len(rows)} exposures in database to process")
-    qarows = []
-    for row in rows:
-        skyflux = _sky(f"{row['path']}/SKY_SPECTRUM_0001.fits")
-        logger.debug("Name %s Sky %s", row["name"], skyflux)
-        qarows.append({"name": row["name"], **skyflux})
+    qarows = _process_rows(_sky_row, rows, njobs)
     if dry_run:
         pprint.pprint(qarows)
     else:
         upsert_many(mr.db, mr.qa_reduced.name, qarows, ["name"])
         
-def qa_fsf(mr, recipe_name=None, dates=None, skip=True, dry_run=False):
+def qa_fsf(
+    mr, recipe_name=None, dates=None, skip=True, dry_run=False, njobs=1, exists=None
+):
     if recipe_name is None:
         recipe_name = "fsf"
-    dates = mr.prepare_dates(dates, DPR_TYPE='OBJECT')
     recipe_name = normalize_recipe_name(recipe_name)
-    rows = list(
-        mr.reduced.find(recipe_name=recipe_name, DPR_TYPE="FSF", name=dates)
-    )
-    if skip:
+    if not skip:
+        exists = set()
+    elif exists is None:
         exists = _find_existing_exp(mr.qa_reduced, "FSF_FWHM_B")
-        rows = [row for row in rows if row["name"] not in exists]
+    rows = _find_exp_rows(
+        mr, mr.reduced, dates, exclude=exists, recipe_name=recipe_name, DPR_TYPE="FSF"
+    )
     logger.info(f"fsf: found {len(rows)} exposures in database to process")
-    qarows = []
-    for row in rows:
-        fsfvals = _fsf(f"{row['path']}/FSF.fits")
-        logger.debug("Name %s FSF %s", row["name"], fsfvals)
-        qarows.append({"name": row["name"], **fsfvals})
+    qarows = _process_rows(_fsf_row, rows, njobs)
     if dry_run:
         pprint.pprint(qarows)
     else:
@@ -126,49 +163,168 @@ def qa_fsf(mr, recipe_name=None, dates=None, skip=True, dry_run=False):
 
 
 
-def qa_sparta(mr, dates=None, skip=True, dry_run=False):
-    dates = mr.prepare_dates(dates, DPR_TYPE='OBJECT')
-    rows = list(mr.raw.find(name=dates))
-    if skip:
+def qa_sparta(mr, dates=None, skip=True, dry_run=False, njobs=1, exists=None):
+    if not skip:
+        exists = set()
+    elif exists is None:
         exists = _find_existing_exp(mr.qa_raw, "SP_See")
-        rows = [row for row in rows if row["name"] not in exists]
+    rows = _find_exp_rows(mr, mr.raw, dates, exclude=exists, DPR_TYPE="OBJECT")
     logger.info(f"sparta: found {len(rows)} exposures in database to process")
-    qarows = []
-    for row in rows:
-        sparta_dict = _sparta(row["path"])
-        if sparta_dict is None:
-            continue
-        logger.debug("Name %s SPARTA %s", row["name"], sparta_dict)
-        qarows.append({"name": row["name"], **sparta_dict})
+    qarows = _process_rows(_sparta_row, rows, njobs)
     if dry_run:
         pprint.pprint(qarows)
     else:
         upsert_many(mr.db, mr.qa_raw.name, qarows, ["name"])
 
 
-def qa_psfrec(mr, dates=None, skip=True, dry_run=False):
+def qa_psfrec(mr, dates=None, skip=True, dry_run=False, njobs=1, exists=None):
     try:
         import muse_psfr  # noqa
     except ImportError:
         logger.error("psfrec: could not find the muse-psfr package")
         return
-    dates = mr.prepare_dates(dates, DPR_TYPE='OBJECT')
-    rows = list(mr.raw.find(name=dates))
-    if skip:
+    if not skip:
+        exists = set()
+    elif exists is None:
         exists = _find_existing_exp(mr.qa_raw, "PR_vers")
-        rows = [row for row in rows if row["name"] not in exists]
+    rows = _find_exp_rows(mr, mr.raw, dates, exclude=exists, DPR_TYPE="OBJECT")
     logger.info(f"psfrec: found {len(rows)} exposures in database to process")
-    for row in rows:
+    qarows = _process_rows(_psfrec_row, rows, njobs)
+    if dry_run:
+        pprint.pprint(qarows)
+    else:
+        upsert_many(mr.db, mr.qa_raw.name, qarows, ["name"])
+
+
+def qa_sparta_psfrec(mr, dates=None, skip=True, dry_run=False, njobs=1, exists=None):
+    """Compute the SPARTA and PSF reconstruction values in a single pass on
+    the raw files, so that each file is read by one process, one computation
+    after the other (the second read then comes from the OS cache).
+
+    ``exists`` is a dict with the sets of exposures which already have the
+    SP_See and PR_vers values.
+
+    """
+    try:
+        import muse_psfr  # noqa
+    except ImportError:
+        logger.error("psfrec: could not find the muse-psfr package")
+        return qa_sparta(mr, dates=dates, skip=skip, dry_run=dry_run, njobs=njobs)
+    if not skip:
+        exists = {"SP_See": set(), "PR_vers": set()}
+    elif exists is None:
+        exists = _find_existing_exps(mr.qa_raw, ["SP_See", "PR_vers"])
+    # skip the exposures which already have both values
+    done = exists["SP_See"] & exists["PR_vers"]
+    rows = _find_exp_rows(mr, mr.raw, dates, exclude=done, DPR_TYPE="OBJECT")
+    tasks = [
+        (row, row["name"] not in exists["SP_See"], row["name"] not in exists["PR_vers"])
+        for row in rows
+    ]
+    logger.info(f"sparta+psfrec: found {len(rows)} exposures in database to process")
+    qarows = _process_rows(_sparta_psfrec_row, tasks, njobs)
+    if dry_run:
+        pprint.pprint(qarows)
+    else:
+        upsert_many(mr.db, mr.qa_raw.name, qarows, ["name"])
+
+
+def _find_exp_rows(mr, table, dates=None, exclude=(), **kwargs):
+    """Find the rows of ``table`` for the valid exposures of ``dates``.
+
+    When ``dates`` is None, all the valid exposures are used. In this case
+    the rows are filtered in Python, instead of building a query with a
+    (potentially huge) IN clause of all the exposure names. The exposures in
+    ``exclude`` are skipped while iterating on the query results.
+
+    """
+    names = mr.prepare_dates(dates, DPR_TYPE="OBJECT")
+    if dates is not None:
+        rows = table.find(name=names, **kwargs)
+    else:
+        names = set(names)
+        rows = (row for row in table.find(**kwargs) if row["name"] in names)
+    return [row for row in rows if row["name"] not in exclude]
+
+
+def _process_rows(func, rows, njobs=1):
+    """Apply ``func`` to each row, in parallel with joblib if njobs != 1, and
+    return the non-null results."""
+    results = Parallel(n_jobs=njobs)(delayed(func)(row) for row in rows)
+    return [res for res in results if res is not None]
+
+
+def _imphot_row(row, band="F775W"):
+    imphot = _imphot(f"{row['path']}/IMPHOT.fits", band=band)
+    imphot["IM_vers"] = row["recipe_version"]
+    logger.debug("Name %s Imphot %s", row["name"], imphot)
+    return {"name": row["name"], **imphot}
+
+
+def _sky_row(row):
+    skyflux = _sky(f"{row['path']}/SKY_SPECTRUM_0001.fits")
+    logger.debug("Name %s Sky %s", row["name"], skyflux)
+    return {"name": row["name"], **skyflux}
+
+
+def _fsf_row(row):
+    fsfvals = _fsf(f"{row['path']}/FSF.fits")
+    logger.debug("Name %s FSF %s", row["name"], fsfvals)
+    return {"name": row["name"], **fsfvals}
+
+
+def _sparta_row(row):
+    sparta_dict = _sparta(row["path"])
+    if sparta_dict is None:
+        return None
+    logger.debug("Name %s SPARTA %s", row["name"], sparta_dict)
+    return {"name": row["name"], **sparta_dict}
+
+
+def _sparta_psfrec_row(task):
+    row, do_sparta, do_psfrec = task
+    res = {"name": row["name"]}
+    if do_sparta:
+        sparta_dict = _sparta(row["path"])
+        if sparta_dict is None:
+            # no SPARTA table, so the PSF reconstruction is not possible
+            return None
+        logger.debug("Name %s SPARTA %s", row["name"], sparta_dict)
+        res.update(sparta_dict)
+    if do_psfrec:
         psfrec_dict = _psfrec(row["path"])
         logger.debug("Name %s PSFRec %s", row["name"], psfrec_dict)
-        if not dry_run:
-            mr.qa_raw.upsert({"name": row["name"], **psfrec_dict}, ["name"])
+        res.update(psfrec_dict)
+    return res
+
+
+def _psfrec_row(row):
+    psfrec_dict = _psfrec(row["path"])
+    logger.debug("Name %s PSFRec %s", row["name"], psfrec_dict)
+    return {"name": row["name"], **psfrec_dict}
 
 
 def _find_existing_exp(table, key):
-    if key not in table.columns:
-        return []
-    exists = [row["name"] for row in table.find() if row[key] is not None]
+    """Return the set of exposure names for which ``key`` is not null."""
+    return _find_existing_exps(table, [key])[key]
+
+
+def _find_existing_exps(table, keys):
+    """Return a dict with, for each key, the set of exposure names for which
+    the key is not null. This is done with a single query."""
+    exists = {key: set() for key in keys}
+    keys = [key for key in keys if key in table.columns]
+    if not keys:
+        return exists
+    col = table.table.c
+    query = sql.select(
+        [col.name] + [col[key] for key in keys],
+        whereclause=sql.or_(*[col[key].isnot(None) for key in keys]),
+    )
+    for name, *values in table.db.executable.execute(query):
+        for key, val in zip(keys, values):
+            if val is not None:
+                exists[key].add(name)
     return exists
 
 
@@ -189,16 +345,40 @@ def _psfrec(filename):
     }
 
 
+def _read_cols(filename, ext, columns):
+    """Read only the given columns of a FITS table, as a dict of arrays.
+
+    This uses fitsio if available, which avoids the creation of the full
+    header and of a Table. Raises a KeyError if the extension is missing.
+
+    """
+    if fitsio is not None:
+        with fitsio.FITS(filename) as f:
+            if ext not in f:
+                raise KeyError(f"extension {ext} not found")
+            data = f[ext].read(columns=columns)
+    else:
+        data = fits.getdata(filename, ext, memmap=False)
+    return {col: np.asarray(data[col]) for col in columns}
+
+
 def _sky(filename):
-    s = Table.read(filename)
-    bands = [["skyB", 4850, 6000], ["skyV", 6000, 8000], ["skyR", 8000, 9300]]
+    s = _read_cols(filename, 1, ["lambda", "data"])
+    bands = ["skyB", "skyV", "skyR"]
+    lmin, lmax = [4850, 6000, 8000], [6000, 8000, 9300]
+    # lambda is sorted, so the bands limits are found with searchsorted (bands
+    # include both limits, hence the overlap), and invalid values are ignored
+    # as they were masked by Table.read
+    lbda, data = s["lambda"], s["data"]
+    start = np.searchsorted(lbda, lmin, side="left")
+    end = np.searchsorted(lbda, lmax, side="right")
     return {
-        band: float(np.mean(s["data"][(s["lambda"] >= l1) & (s["lambda"] <= l2)]))
-        for band, l1, l2 in bands
+        band: float(np.nanmean(data[i:j], dtype=float))
+        for band, i, j in zip(bands, start, end)
     }
 
 def _fsf(filename):
-    t = Table.read(filename)
+    t = Table.read(filename, memmap=True)
     keys = [["FSF_FWHM_B","FWHM_B"],["FSF_BETA_B","BETA_B"],
             ["FSF_FWHM_V","FWHM_V"],["FSF_BETA_V","BETA_V"],
             ["FSF_FWHM_R","FWHM_R"],["FSF_BETA_R","BETA_R"]]
@@ -209,8 +389,11 @@ def _fsf(filename):
 
 
 def _sparta(rawname):
+    columns = [
+        f"LGS{k}_{col}" for k in range(1, 5) for col in ("SEEING", "TUR_GND", "L0")
+    ]
     try:
-        tab = Table.read(rawname, hdu="SPARTA_ATM_DATA")
+        tab = _read_cols(rawname, "SPARTA_ATM_DATA", columns)
     except KeyError:
         logger.error(f"no SPARTA_ATM_DATA table in {rawname}")
         return
@@ -220,29 +403,25 @@ def _sparta(rawname):
         logger.warning("Mode %d lasers detected", len(klist))
 
     res = {}
-
-    s = [tab[f"LGS{k}_SEEING"].mean() for k in klist]
-    res["SP_See"] = float(np.mean(s))
-    res["SP_SeeStd"] = float(np.std(s))
-    res["SP_SeeMin"] = float(np.min([tab[f"LGS{k}_SEEING"].min() for k in klist]))
-    res["SP_SeeMax"] = float(np.max([tab[f"LGS{k}_SEEING"].max() for k in klist]))
-
-    g = [tab[f"LGS{k}_TUR_GND"].mean() for k in klist]
-    res["SP_Gl"] = float(np.mean(g))
-    res["SP_GlStd"] = float(np.std(g))
-    res["SP_GLMin"] = float(np.min([tab[f"LGS{k}_TUR_GND"].min() for k in klist]))
-    res["SP_GLMax"] = float(np.max([tab[f"LGS{k}_TUR_GND"].max() for k in klist]))
-
-    l = [tab[f"LGS{k}_L0"].mean() for k in klist]
-    res["SP_L0"] = float(np.mean(l))
-    res["SP_L0Std"] = float(np.std(l))
-    res["SP_L0Min"] = float(np.min([tab[f"LGS{k}_L0"].min() for k in klist]))
-    res["SP_L0Max"] = float(np.max([tab[f"LGS{k}_L0"].max() for k in klist]))
+    keys = [
+        ("SEEING", "SP_See", "SP_SeeStd", "SP_SeeMin", "SP_SeeMax"),
+        ("TUR_GND", "SP_Gl", "SP_GlStd", "SP_GLMin", "SP_GLMax"),
+        ("L0", "SP_L0", "SP_L0Std", "SP_L0Min", "SP_L0Max"),
+    ]
+    for col, kmean, kstd, kmin, kmax in keys:
+        # array of shape (nlasers, nvalues), ignoring invalid values as they
+        # were masked by Table.read
+        data = np.array([tab[f"LGS{k}_{col}"] for k in klist])
+        mean_per_laser = np.nanmean(data, axis=1)
+        res[kmean] = float(np.nanmean(mean_per_laser))
+        res[kstd] = float(np.nanstd(mean_per_laser))
+        res[kmin] = float(np.nanmin(data))
+        res[kmax] = float(np.nanmax(data))
     return res
 
 
 def _imphot(tabname, band="F775W"):
-    tab = Table.read(tabname)
+    tab = Table.read(tabname, memmap=True)
     if band not in tab["filter"]:
         raise ValueError("band {band} not found")
     row = tab[tab["filter"] == band][0]
@@ -1,11 +1,13 @@
 import datetime
 import fnmatch
+import io
 import itertools
 import logging
 import numbers
 import os
 import re
 from collections import OrderedDict, defaultdict
+from functools import lru_cache
 from os.path import expanduser
 
 import dataset
@@ -14,16 +16,40 @@ import yaml
 from astropy.io import ascii, fits
 from astropy.stats import sigma_clip
 from astropy.table import MaskedColumn, Table, vstack
+from joblib import Parallel, delayed
 from mpdaf.obj import Cube
 from mpdaf.tools import isiter, progressbar
 from sqlalchemy import event, func, pool, sql
-from sqlalchemy.engine import Engine
 
 from .settings import QC_KEYWORDS, RAW_FITS_KEYWORDS
 
-EXP_PATTERN = r"\d{4}-\d{2}-\d{2}T\d{2}:\d{2}:\d{2}.\d{3}"
+try:
+    # use the libyaml parser if available, which is much faster
+    from yaml import CSafeLoader as YamlLoader
+except ImportError:
+    from yaml import SafeLoader as YamlLoader
+
+EXP_PATTERN = re.compile(r"\d{4}-\d{2}-\d{2}T\d{2}:\d{2}:\d{2}\.\d{3}")
 DATETIME_PATTERN = "%Y-%m-%dT%H:%M:%S.%f"
+DATETIME_REGEX = re.compile(
+    r"(\d{4})-(\d{2})-(\d{2})T(\d{2}):(\d{2}):(\d{2})\.(\d{1,6})"
+)
 DATE_PATTERN = "%Y-%m-%d"
+DATE_REGEX = re.compile(r"(\d{4})-(\d{2})-(\d{2})")
+FITS_BLOCK_SIZE = 2880
+FITS_SIGNATURE = b"SIMPLE  =                    T"
+FITS_CHUNK_RECORDS = 1024  # number of records read at once for the data
+END_CARD_PATTERN = re.compile(rb"END {77}")
+CARD_VALUE_PATTERN = re.compile(
+    r"= *(?:'((?:[^']|'')*)'|([TF])|([+-]?\d+)|"
+    r"([+-]?(?:\d+\.?\d*|\.\d+)(?:[EeDd][+-]?\d+)?)) *(?:/.*)?$"
+)
+DATA_SIZE_KEYWORDS = ("BITPIX", "NAXIS", "PCOUNT", "GCOUNT")
+CHECKSUM_KEYWORDS = DATA_SIZE_KEYWORDS + ("CHECKSUM", "DATASUM")
+QC_CARD_PREFIX = b"HIERARCH ESO QC "
+RAW_KEYWORDS = tuple(
+    k.split("/")[0].strip() for k in RAW_FITS_KEYWORDS.splitlines() if k.strip()
+)
 NOON = datetime.time(20, 40, 0)
 ONEDAY = datetime.timedelta(days=1)
 
@@ -43,16 +69,23 @@ def load_yaml_config(filename):
         return confdict
 
     # We need to do 2 passes, before and after key substitution
-    conf = yaml.safe_load(conftext)
+    conf = yaml.load(conftext, Loader=YamlLoader)
     conf = expand_user_in_conf(conf)
-    conf = yaml.safe_load(conftext.format(**conf))
+    conf = yaml.load(conftext.format(**conf), Loader=YamlLoader)
     conf = expand_user_in_conf(conf)
 
     return conf
 
 
-def load_db(filename=None, db_env=None, **kwargs):
-    """Open a sqlite database with dataset."""
+def load_db(filename=None, db_env=None, persistent=False, **kwargs):
+    """Open a sqlite database with dataset.
+
+    By default a new connection is opened for each transaction. With
+    ``persistent=True`` a single connection is kept open, which avoids
+    reconnecting and setting the pragmas for each query, but this connection
+    must not be shared between threads or processes.
+
+    """
 
     kwargs.setdefault("engine_kwargs", {})
 
@@ -66,7 +99,9 @@ def load_db(filename=None, db_env=None, **kwargs):
 
         # Use a NullPool by default, which is sqlalchemy's default but dataset
         # uses instead a StaticPool.
-        kwargs["engine_kwargs"].setdefault("poolclass", pool.NullPool)
+        kwargs["engine_kwargs"].setdefault(
+            "poolclass", pool.StaticPool if persistent else pool.NullPool
+        )
 
         url = f"sqlite:///{filename}"
     elif db_env is not None:
@@ -87,11 +122,14 @@ def load_db(filename=None, db_env=None, **kwargs):
 
     if db.engine.driver == "pysqlite":
 
-        @event.listens_for(Engine, "connect")
+        # listen on this engine only, to not add a listener to all the engines
+        # for each opened database
+        @event.listens_for(db.engine, "connect")
         def set_sqlite_pragma(dbapi_connection, connection_record):
             cursor = dbapi_connection.cursor()
             cursor.execute("PRAGMA foreign_keys = ON")
             cursor.execute("PRAGMA cache_size = -100000")
+            cursor.execute("PRAGMA temp_store = MEMORY")
             # cursor.execute('PRAGMA journal_mode = WAL')
             cursor.close()
 
@@ -102,12 +140,14 @@ def load_table(db, name, indexes=None):
     """Load a table from the database as an astropy Table."""
     logger = logging.getLogger(__name__)
     table = db[name]
-    first = table.find_one()
-    t = Table(
-        list(zip(*[list(o.values()) for o in table.find()])),
-        names=list(first.keys()),
-        masked=True,
-    )
+    # select the rows as tuples, without creating a dict for each row
+    result = db.executable.execute(table.table.select())
+    names = list(result.keys())
+    rows = result.fetchall()
+    if rows:
+        t = Table(list(zip(*rows)), names=names, masked=True)
+    else:
+        t = Table(names=names, masked=True)
 
     for name, col in t.columns.items():
         if col.dtype is np.dtype(object):
@@ -117,11 +157,13 @@ def load_table(db, name, indexes=None):
                 pass
             else:
                 logger.debug("Converted %s column to float", col.name)
+                # NULL values are converted to NaN, mask them without copy
                 c = MaskedColumn(
                     name=col.name,
-                    dtype=float,
                     fill_value=np.nan,
-                    data=np.ma.masked_invalid(data),
+                    data=data,
+                    mask=~np.isfinite(data),
+                    copy=False,
                 )
                 t.replace_column(name, c)
         elif np.issubdtype(col.dtype, np.floating):
@@ -142,10 +184,8 @@ def get_exp_name(filename):
     >>>
 
     """
-    try:
-        return re.findall(EXP_PATTERN, filename)[0]
-    except IndexError:
-        return None
+    m = EXP_PATTERN.search(filename)
+    return m.group(0) if m else None
 
 
 def parse_datetime(exp):
@@ -155,22 +195,64 @@ def parse_datetime(exp):
     datetime.datetime(2018, 9, 8, 10, 19, 47, 146000)
 
     """
-    return datetime.datetime.strptime(exp, DATETIME_PATTERN)
+    # parse the usual format with a regex, which is much faster than strptime
+    m = DATETIME_REGEX.fullmatch(exp)
+    if m is None:
+        return datetime.datetime.strptime(exp, DATETIME_PATTERN)
+    *values, frac = m.groups()
+    return datetime.datetime(*map(int, values), int(frac.ljust(6, "0")))
 
 
+@lru_cache(maxsize=1024)
 def parse_date(exp):
     """Parse a date string to a datetime object.
 
+    The result is cached, as the same nights are parsed many times when
+    looking for the frames valid for a date.
+
     >>> parse_date('2018-09-08')
     datetime.date(2018, 9, 8)
 
     """
-    return datetime.datetime.strptime(exp, DATE_PATTERN).date()
+    m = DATE_REGEX.fullmatch(exp)
+    if m is None:
+        return datetime.datetime.strptime(exp, DATE_PATTERN).date()
+    return datetime.date(*map(int, m.groups()))
 
 
+def get_night(dateobs):
+    """Return the night of an observation from its DATE-OBS value.
+
+    Observations taken before `NOON` (in UT) belong to the previous night,
+    same as MuseWise. `datetime.datetime.fromisoformat` is used as it is much
+    faster than ``strptime``, with a fallback on `parse_datetime` for the
+    values it does not support. Dates without a time are returned as is.
+
+    >>> get_night('2017-06-16T01:34:56.867')
+    datetime.date(2017, 6, 15)
+    >>> get_night('2017-06-16')
+    datetime.date(2017, 6, 16)
+
+    """
+    if "T" not in dateobs:
+        return parse_date(dateobs)
+    try:
+        date = datetime.datetime.fromisoformat(dateobs)
+    except ValueError:
+        date = parse_datetime(dateobs)
+    night = date.date()
+    if date.time() < NOON:
+        night -= ONEDAY
+    return night
+
+
+@lru_cache(maxsize=None)
 def normalize_keyword(key):
     """Normalize FITS keywords to use it as a database column name.
 
+    The result is cached, as the same QC keywords are normalized for each
+    file and HDU.
+
     >>> normalize_keyword('foo')
     'foo'
     >>> normalize_keyword('FOO BAR')
@@ -188,15 +270,292 @@ def normalize_keyword(key):
     return key.replace(" ", "_").replace("-", "_")
 
 
-def parse_raw_keywords(flist, datasets, runs=None, additional_keywords=None):
+def _parse_card_value(card):
+    """Parse the value of a FITS card image.
+
+    Simple values (strings, booleans, integers and floats) are parsed with a
+    regex, and other values (e.g. long strings with CONTINUE cards) with
+    `astropy.io.fits.Card`. Undefined values are returned as None.
+
+    """
+    m = None if len(card) > 80 else CARD_VALUE_PATTERN.search(card, 8)
+    if m is None:
+        value = fits.Card.fromstring(card).value
+        # undefined values are returned as None, as with Header.get
+        return None if value is fits.card.UNDEFINED else value
+    string, boolean, integer, floating = m.groups()
+    if string is not None:
+        return string.rstrip().replace("''", "'")
+    elif boolean is not None:
+        return boolean == "T"
+    elif integer is not None:
+        return int(integer)
+    else:
+        return float(floating.replace("D", "E").replace("d", "e"))
+
+
+def _normalize_card_keyword(keyword):
+    """Normalize a keyword as astropy does for the lookups, uppercase and
+    without the HIERARCH prefix."""
+    keyword = keyword.strip().upper()
+    if keyword.startswith("HIERARCH "):
+        keyword = keyword[9:].strip()
+    return keyword
+
+
+def _find_card(header, keyword):
+    """Return the position of the first card of ``keyword`` in the header
+    bytes, or -1 if not found."""
+    keyword = _normalize_card_keyword(keyword)
+    hierarch = len(keyword) > 8 or " " in keyword
+    if hierarch:
+        pattern = b"HIERARCH " + keyword.encode()
+    else:
+        pattern = keyword.encode().ljust(8) + b"="
+    i = header.find(pattern)
+    while i != -1:
+        # the match must be at the beginning of a card, and for HIERARCH
+        # cards the keyword must be followed by the value indicator, with or
+        # without spaces
+        if i % 80 == 0 and (
+            not hierarch or header[i + len(pattern) : i + 80].lstrip()[:1] == b"="
+        ):
+            return i
+        i = header.find(pattern, i + 1)
+    return -1
+
+
+def _read_header_bytes(fd):
+    """Read the header records of the next HDU, until the END card.
+
+    Returns the header bytes, an empty bytes string at the end of the file, or
+    None if the file is truncated.
+
+    """
+    blocks = []
+    while True:
+        block = fd.read(FITS_BLOCK_SIZE)
+        if not block and not blocks:
+            return b""
+        if len(block) < FITS_BLOCK_SIZE:
+            return None  # truncated header
+        blocks.append(block)
+        if any(m.start() % 80 == 0 for m in END_CARD_PATTERN.finditer(block)):
+            return b"".join(blocks)
+
+
+def _get_card_values(header, keywords):
+    """Return a dict with the values of ``keywords`` from the header bytes,
+    None for missing keywords."""
+    values = {}
+    for key in keywords:
+        i = _find_card(header, key)
+        if i == -1:
+            values[key] = None
+            continue
+        # long string values are continued on the next cards
+        j = i + 80
+        while header.startswith(b"CONTINUE", j):
+            j += 80
+        values[key] = _parse_card_value(header[i:j].decode("ascii", "replace"))
+    return values
+
+
+def _get_data_size(header, cards):
+    """Return the size in bytes (without padding) of the data of a HDU.
+
+    ``cards`` must contain the values of `DATA_SIZE_KEYWORDS`. Header-only
+    HDUs have no data.
+
+    """
+    naxis = cards["NAXIS"] or 0
+    if naxis == 0:
+        return 0
+    naxes = _get_card_values(header, [f"NAXIS{i}" for i in range(1, naxis + 1)])
+    return (
+        abs(cards["BITPIX"])
+        // 8
+        * (cards["GCOUNT"] or 1)
+        * ((cards["PCOUNT"] or 0) + int(np.prod(list(naxes.values()))))
+    )
+
+
+def _iter_header_bytes(filename):
+    """Iterate over the header bytes of all the HDUs of a FITS file.
+
+    The data of the HDUs are skipped without being read.
+
+    """
+    with open(filename, mode="rb") as fd:
+        if not fd.peek(FITS_BLOCK_SIZE).startswith(FITS_SIGNATURE):
+            raise OSError(f"{filename} is not a valid FITS file")
+        while True:
+            header = _read_header_bytes(fd)
+            if header is None:
+                raise OSError(f"{filename} is truncated")
+            if not header:
+                return
+            yield header
+            size = _get_data_size(header, _get_card_values(header, DATA_SIZE_KEYWORDS))
+            fd.seek(-(-size // FITS_BLOCK_SIZE) * FITS_BLOCK_SIZE, os.SEEK_CUR)
+
+
+def _get_qc_cards(header):
+    """Return a dict with the QC keywords and values from the header bytes."""
+    cards = {}
+    i = header.find(QC_CARD_PREFIX)
+    while i != -1:
+        if i % 80 == 0:
+            # long string values are continued on the next cards
+            j = i + 80
+            while header.startswith(b"CONTINUE", j):
+                j += 80
+            card = header[i:j].decode("ascii", "replace")
+            keyword = card[9 : card.index("=")].strip()
+            cards[keyword] = _parse_card_value(card)
+        i = header.find(QC_CARD_PREFIX, i + 1)
+    return cards
+
+
+def read_raw_header(filename, keywords):
+    """Return a dict with the values of the given keywords for a raw file.
+
+    The keywords are read from the primary header. Instead of parsing the
+    full header with astropy, the cards of the given keywords are searched in
+    the header bytes, and only these cards are parsed. The header is parsed
+    with astropy only when a keyword that was not found appears in the header
+    bytes, e.g. for non-standard cards. If the file is not a valid FITS file,
+    None is returned.
+
+    """
+    with open(filename, mode="rb") as fd:
+        # peek the signature in the read buffer, which is then used to read
+        # the header records, to avoid a seek and a second read
+        if not fd.peek(FITS_BLOCK_SIZE).startswith(FITS_SIGNATURE):
+            return None
+        header = _read_header_bytes(fd)
+
+    if not header:
+        return None
+    values = _get_card_values(header, keywords)
+
+    missing = [
+        key
+        for key, val in values.items()
+        if val is None
+        and _find_card(header, key) == -1
+        and _normalize_card_keyword(key).encode() in header
+    ]
+    if missing:
+        hdr = fits.getheader(filename)
+        for key in missing:
+            values[key] = hdr.get(key)
+    return values
+
+
+def iter_raw_headers(flist, keywords, n_jobs=1, chunksize=32):
+    """Iterate over the headers of raw files, read with `read_raw_header`.
+
+    If n_jobs != 1, the headers are read in parallel with joblib (-1 to use
+    all the CPUs), by batches of ``chunksize`` files, and are yielded in the
+    order of ``flist`` as soon as they are available. With n_jobs=1 the files
+    are read sequentially, without worker processes.
+
+    """
+    parallel = Parallel(n_jobs=n_jobs, batch_size=chunksize, return_as="generator")
+    yield from parallel(delayed(read_raw_header)(f, keywords) for f in flist)
+
+
+def _fold_carry(s):
+    """Fold the carry bits of a sum into 32 bits (1's complement addition)."""
+    while s >> 32:
+        s = (s & 0xFFFFFFFF) + (s >> 32)
+    return s
+
+
+def _ones_complement_sum(buf, sum32=0):
+    """Add the 32-bit big-endian words of ``buf`` to ``sum32``."""
+    return _fold_carry(
+        sum32 + int(np.frombuffer(buf, dtype=">u4").sum(dtype=np.uint64))
+    )
+
+
+def verify_fits_checksum(filename):
+    """Verify the CHECKSUM and DATASUM keywords of all HDUs of a FITS file.
+
+    The file is read sequentially, by FITS records of 2880 bytes for the
+    headers and by chunks of records for the data, and the checksums are
+    accumulated on the raw bytes with numpy. This avoids the creation of the
+    HDU objects and the interpretation of the data by astropy.
+
+    Returns
+    -------
+    int or None
+        The number of HDUs if all checksums are valid, None otherwise (also
+        if a HDU does not have both CHECKSUM and DATASUM keywords).
+
+    """
+    nhdus = 0
+    buf = memoryview(bytearray(FITS_BLOCK_SIZE * FITS_CHUNK_RECORDS))
+    with open(filename, mode="rb") as f:
+        while True:
+            # Header: read the records until the END card, and parse only the
+            # cards needed to compute the data size and verify the checksums
+            header = _read_header_bytes(f)
+            if header is None:
+                return None  # truncated file
+            if not header:
+                return nhdus
+            hdrsum = _ones_complement_sum(header)
+            cards = _get_card_values(header, CHECKSUM_KEYWORDS)
+            if cards["CHECKSUM"] is None or cards["DATASUM"] is None:
+                return None
+
+            # Data: the size is computed from the header keywords
+            size = _get_data_size(header, cards)
+            # Read the data (with padding) by chunks of FITS records, and
+            # compute the sum with one vectorized operation per chunk
+            datasum = 0
+            remaining = -(-size // FITS_BLOCK_SIZE) * FITS_BLOCK_SIZE
+            while remaining > 0:
+                nbytes = f.readinto(buf[: min(remaining, len(buf))])
+                if nbytes < min(remaining, len(buf)):
+                    return None  # truncated file
+                datasum = _ones_complement_sum(buf[:nbytes], datasum)
+                remaining -= nbytes
+
+            if datasum != int(cards["DATASUM"]):
+                return None
+            # the sum over the whole HDU must be -0 in 1's complement
+            if _fold_carry(hdrsum + datasum) != 0xFFFFFFFF:
+                return None
+            nhdus += 1
+
+
+def parse_raw_keywords(flist, datasets, runs=None, additional_keywords=None, n_jobs=1):
+    """Return the list of rows for the raw table, see `iter_raw_keywords`."""
+    return list(
+        iter_raw_keywords(
+            flist,
+            datasets,
+            runs=runs,
+            additional_keywords=additional_keywords,
+            n_jobs=n_jobs,
+        )
+    )
+
+
+def iter_raw_keywords(flist, datasets, runs=None, additional_keywords=None, n_jobs=1):
+    """Iterate over the rows for the raw table, with the keyword values
+    from the headers of the FITS files in ``flist``."""
     logger = logging.getLogger(__name__)
     invalid = []
-    rows = []
     runs = runs or {}
+    night_runs = {}
     now = datetime.datetime.now().isoformat()
 
     # prepare the list of FITS keywords to use
-    keywords = [k.split("/")[0].strip() for k in RAW_FITS_KEYWORDS.splitlines() if k]
+    keywords = list(RAW_KEYWORDS)
     if additional_keywords:
         logger.info("adding additional keywords: %s", additional_keywords)
         for key in additional_keywords:
@@ -223,22 +582,32 @@ def parse_raw_keywords(flist, datasets, runs=None, additional_keywords=None):
             # if OBJECT is not specified just use the dataset name
             objects[name] = name
 
-    for f in progressbar(flist):
-        with open(f, mode="rb") as fd:
-            if fd.read(30) != b"SIMPLE  =                    T":
-                # detect invalid FITS files, when we have been logged out and
-                # got the login page instead (which should not happen when
-                # astroquery 0.3.10 is released)
-                size = os.stat(f).st_size
-                if 11_000 < size < 12_000:
-                    invalid.append(f)
-                else:
-                    logger.error("invalid FITS file %s", f)
-                continue
+    # column names for the keywords
+    columns = [(key, normalize_keyword(key)) for key in keywords]
+
+    # read the headers, in parallel if n_jobs != 1
+    chunksize = 32
+    headers = iter_raw_headers(
+        flist, ["OBJECT"] + keywords, n_jobs=n_jobs, chunksize=chunksize
+    )
+
+    # in parallel the headers arrive by chunks, so the progress bar is
+    # refreshed only once per chunk
+    bar_kw = {"miniters": chunksize} if n_jobs != 1 else {}
+    for f, hdr in zip(progressbar(flist, **bar_kw), headers):
+        if hdr is None:
+            # detect invalid FITS files, when we have been logged out and
+            # got the login page instead (which should not happen when
+            # astroquery 0.3.10 is released)
+            size = os.stat(f).st_size
+            if 11_000 < size < 12_000:
+                invalid.append(f)
+            else:
+                logger.error("invalid FITS file %s", f)
+            continue
 
         logger.debug("parsing %s", f)
-        hdr = fits.getheader(f, ext=0)
-        obj = hdr.get("OBJECT")
+        obj = hdr["OBJECT"]
 
         row = OrderedDict(
             [
@@ -253,32 +622,29 @@ def parse_raw_keywords(flist, datasets, runs=None, additional_keywords=None):
             ]
         )
 
-        if "DATE-OBS" in hdr:
+        if hdr["DATE-OBS"] is not None:
             try:
-                try:
-                    date = parse_datetime(hdr["DATE-OBS"])
-                    night = date.date()
-                    time = date.time()
-                except ValueError:
-                    night = parse_date(hdr["DATE-OBS"])
-                    time = NOON
-
-                # Same as MuseWise
-                if time < NOON:
-                    night -= ONEDAY
+                night = get_night(hdr["DATE-OBS"])
                 row["night"] = night.isoformat()
 
-                for run_name, run in runs.items():
-                    if run["start_date"] <= night <= run["end_date"]:
-                        row["run"] = run_name
-                        break
+                # the run is the same for all the exposures of a night
+                if night not in night_runs:
+                    night_runs[night] = next(
+                        (
+                            run_name
+                            for run_name, run in runs.items()
+                            if run["start_date"] <= night <= run["end_date"]
+                        ),
+                        None,
+                    )
+                row["run"] = night_runs[night]
             except Exception as e:
                 logger.warning("could not parse DATE-OBS from %s: %s", f, e)
 
-        for key in keywords:
-            row[normalize_keyword(key)] = hdr.get(key)
+        for key, col in columns:
+            row[col] = hdr.get(key)
 
-        rows.append(row)
+        yield row
 
     if invalid:
         logger.error(
@@ -290,42 +656,84 @@ def parse_raw_keywords(flist, datasets, runs=None, additional_keywords=None):
             logger.error("- %s", f)
             os.remove(f)
 
-    return rows
-
 
 def parse_qc_keywords(flist):
     logger = logging.getLogger(__name__)
     rows = []
     for f in sorted(flist):
-        with fits.open(f) as hdul:
-            catg = hdul[0].header.get("ESO PRO CATG")
-            keyw_filter = QC_KEYWORDS.get(catg)
-
-            for hdu in hdul:
-                if "." in hdu.name:
-                    name, ext = hdu.name.split(".")
-                    if ext in ("DQ", "STAT"):
-                        continue
-                else:
-                    name = hdu.name
-                cards = {
-                    normalize_keyword(key): val
-                    for key, val in hdu.header["ESO QC*"].items()
-                }
+        # only the headers are needed, so they are read directly from the file
+        # bytes, skipping the data, and only the QC cards are parsed
+        for i, header in enumerate(_iter_header_bytes(f)):
+            if i == 0:
+                catg = _get_card_values(header, ["ESO PRO CATG"])["ESO PRO CATG"]
+                keyw_filter = QC_KEYWORDS.get(catg)
+
+            name = _get_card_values(header, ["EXTNAME"])["EXTNAME"]
+            if name is None:
+                name = "PRIMARY" if i == 0 else ""
+            name = str(name)
+            if "." in name:
+                name, ext = name.split(".")
+                if ext in ("DQ", "STAT"):
+                    continue
+            cards = {
+                normalize_keyword(key): val
+                for key, val in _get_qc_cards(header).items()
+            }
 
-                if keyw_filter:
-                    keys = set()
-                    for filt in keyw_filter:
-                        keys.update(fnmatch.filter(cards.keys(), filt))
-                    cards = {k: v for k, v in cards.items() if k in keys}
+            if keyw_filter:
+                keys = set()
+                for filt in keyw_filter:
+                    keys.update(fnmatch.filter(cards.keys(), filt))
+                cards = {k: v for k, v in cards.items() if k in keys}
 
-                if len(cards) == 0:
-                    logger.debug("%s - %s : no QC keywords", f, name)
-                    continue
-                rows.append({"filename": os.path.basename(f), "hdu": name, **cards})
+            if len(cards) == 0:
+                logger.debug("%s - %s : no QC keywords", f, name)
+                continue
+            rows.append({"filename": os.path.basename(f), "hdu": name, **cards})
     return rows
 
 
+def _count_whereclause(c, datecol, date_list=None, run=None):
+    """Return the clause used to select the dates for the counts."""
+    if date_list:
+        if len(date_list) == 1:
+            return datecol.like(f"%{date_list[0]}%")
+        else:
+            return datecol.in_(date_list)
+    elif run is not None and "run" in c:
+        return c["run"].like(f"%{run}%")
+    else:
+        return datecol.isnot(None)
+
+
+def counts_to_table(counts):
+    """Build a table of counts from a list of (name, key, count) items.
+
+    The table contains one row per name and one column per key, and counts
+    for the same (name, key) are summed.
+
+    """
+    counts = list(counts)
+    if len(counts) == 0:
+        return
+
+    # reorganize counts to have types (in columns) per night (rows), with
+    # the columns sorted by name
+    names = sorted({name for name, obj, count in counts})
+    keys = sorted({obj for name, obj, count in counts})
+    names_idx = {name: i for i, name in enumerate(names)}
+    keys_idx = {key: i for i, key in enumerate(keys)}
+    data = np.zeros((len(names), len(keys)), dtype=int)
+    for name, obj, count in counts:
+        data[names_idx[name], keys_idx[obj]] += count
+
+    # mask the missing counts at once, and shorten recipe names
+    data = np.ma.masked_equal(data, 0)
+    colnames = ["name"] + [key.replace("muse_", "") for key in keys]
+    return Table([names] + list(data.T), names=colnames, masked=True)
+
+
 def query_count_to_table(
     table,
     exclude_obj=None,
@@ -339,18 +747,10 @@ def query_count_to_table(
     c = table.table.c
     datecol, countcol = c[datecol], c[countcol]
 
-    if date_list:
-        if len(date_list) == 1:
-            whereclause = [datecol.like(f"%{date_list[0]}%")]
-        else:
-            whereclause = [datecol.in_(date_list)]
-    elif run is not None and "run" in c:
-        whereclause = [c["run"].like(f"%{run}%")]
-    else:
-        whereclause = [datecol.isnot(None)]
-
-    whereclause.append(countcol.isnot(None))
-
+    whereclause = [
+        _count_whereclause(c, datecol, date_list=date_list, run=run),
+        countcol.isnot(None),
+    ]
     if exclude_obj is not None:
         whereclause.append(c.OBJECT.notin_(exclude_obj))
     if exclude_names is not None:
@@ -361,52 +761,103 @@ def query_count_to_table(
     query = (
         sql.select([datecol, countcol, func.count()])
         .where(sql.and_(*whereclause))
-        .order_by(datecol)
         .group_by(datecol, countcol)
     )
+    return counts_to_table(table.db.executable.execute(query))
 
-    # reorganize rows to have types (in columns) per night (rows)
-    rows = defaultdict(dict)
-    keys = set()
-    for name, obj, count in table.db.executable.execute(query):
-        rows[name]["name"] = name
-        rows[name][obj] = count
-        keys.add(obj)
 
-    if len(rows) == 0:
-        return
+def query_count_by_category(
+    table,
+    datecols,
+    date_list=None,
+    run=None,
+    catgcol="DPR_CATG",
+    countcol="recipe_name",
+    exclude_names=None,
+):
+    """Same as `query_count_to_table` for several categories at once.
 
-    # set default counts
-    for row, key in itertools.product(rows.values(), keys):
-        row.setdefault(key, 0)
+    The counts are computed with a single query, and ``datecols`` is a dict
+    giving the date column to use for each category. Returns a dict with the
+    table of counts for each category.
 
-    t = Table(rows=list(rows.values()), masked=True)
-    # move name column to the beginning
-    t.columns.move_to_end("name", last=False)
-    for col in list(t.columns.values())[1:]:
-        col[col == 0] = np.ma.masked
+    """
+    c = table.table.c
+    catgcol, countcol = c[catgcol], c[countcol]
+    datenames = sorted(set(datecols.values()))
+
+    whereclause = [
+        sql.or_(
+            *[
+                sql.and_(
+                    catgcol == catg,
+                    _count_whereclause(c, c[col], date_list=date_list, run=run),
+                )
+                for catg, col in datecols.items()
+            ]
+        ),
+        countcol.isnot(None),
+    ]
+    if exclude_names is not None:
+        whereclause.append(c.name.notin_(exclude_names))
 
-    for col in list(t.columns.values())[1:]:
-        # shorten recipe names
-        col.name = col.name.replace("muse_", "")
+    groupcols = [catgcol, countcol] + [c[col] for col in datenames]
+    query = (
+        sql.select(groupcols + [func.count()])
+        .where(sql.and_(*whereclause))
+        .group_by(*groupcols)
+    )
 
-    return t
+    counts = defaultdict(list)
+    for catg, obj, *dates, count in table.db.executable.execute(query):
+        date = dates[datenames.index(datecols[catg])]
+        counts[catg].append((date, obj, count))
+
+    return {catg: counts_to_table(counts[catg]) for catg in datecols}
+
+
+def _find_in(table, column, values, columns, chunksize=900):
+    """Find the rows of ``table`` for which ``column`` is in ``values``.
+
+    Only the given ``columns`` (if they exist) are selected, with a core
+    SQLAlchemy query to avoid the processing of all the columns by dataset.
+    The query is done by chunks of values, to keep the IN clause below the
+    SQLite limit on the number of bound parameters.
+
+    """
+    if not table.exists or column not in table.columns:
+        return
+    c = table.table.c
+    query = sql.select([c[col] for col in columns if col in c])
+    for i in range(0, len(values), chunksize):
+        whereclause = c[column].in_(values[i : i + chunksize])
+        for row in table.db.executable.execute(query.where(whereclause)):
+            yield dict(row)
 
 
 def parse_gto_db(musered_db, gto_dblist):
     ranks = {2: "A", 3: "B", 4: "C", 5: "D", 6: "X", 7: "a", 8: "b"}
     exps = list(musered_db["raw"].find(DPR_TYPE="OBJECT"))
-    OBstart = [exp["OBS_START"] for exp in exps]
-    arcf = [exp["ARCFILE"] for exp in exps]
+    # the exposures of an OB share the same OBS_START, which may be missing
+    OBstart = sorted({exp["OBS_START"] for exp in exps} - {None})
+    arcf = [exp["ARCFILE"] for exp in exps if exp["ARCFILE"] is not None]
+    comment_cols = ("comment", "date", "author")
 
     flags, comments, fcomments = {}, {}, {}
     for f in gto_dblist:
-        db = load_db(f)
-        flags.update({r["OBstart"]: r for r in db["OBflags"].find(OBstart=OBstart)})
-        comments.update(
-            {r["OBstart"]: r for r in db["OBcomments"].find(OBstart=OBstart)}
-        )
-        fcomments.update({r["arcfile"]: r for r in db["fcomments"].find(arcfile=arcf)})
+        db = load_db(f, persistent=True)
+        for r in _find_in(db["OBflags"], "OBstart", OBstart, ("OBstart", "flag")):
+            flags[r["OBstart"]] = r
+        for r in _find_in(
+            db["OBcomments"], "OBstart", OBstart, ("OBstart",) + comment_cols
+        ):
+            comments[r["OBstart"]] = r
+        for r in _find_in(
+            db["fcomments"], "arcfile", arcf, ("arcfile",) + comment_cols
+        ):
+            fcomments[r["arcfile"]] = r
+        # close the connection kept open by the persistent pool
+        db.engine.dispose()
 
     rows = []
     for exp in exps:
@@ -431,9 +882,10 @@ def parse_gto_db(musered_db, gto_dblist):
 
     with musered_db as tx:
         table = tx["gto_logs"]
-        table.drop()
+        # empty the table instead of dropping it, to keep its schema and index
+        table.delete()
         table.insert_many(rows)
-        table.create_index(["name", "OBstart", "flag", "version"])
+        table.create_index(["name", "OBS_START", "flag", "version"])
 
     return table
 
@@ -447,9 +899,10 @@ def parse_weather_conditions(mr, force=False):
     wc = mr.rawc.DPR_TYPE == "OBJECT"
     if not force:
         weather_tbl = mr.db["weather_conditions"]
-        existing_nights = [o["night"] for o in weather_tbl.find()]
-        logger.debug("Skipping %d nights", len(existing_nights))
-        wc = wc & (mr.rawc.night.notin_(existing_nights))
+        logger.debug("Skipping %d nights", weather_tbl.count())
+        if weather_tbl.exists:
+            # use a subquery instead of passing the list of nights
+            wc = wc & ~sql.exists().where(weather_tbl.table.c.night == mr.rawc.night)
 
     query = sql.select([mr.rawc.night, mr.rawc.path]).where(wc).order_by(mr.rawc.path)
     tables = []
@@ -494,7 +947,13 @@ def parse_weather_conditions(mr, force=False):
             continue
 
         try:
-            tbl = ascii.read("".join(lines))
+            # the weather conditions are tab-separated, which can be read
+            # directly with the fast reader, and otherwise fallback to the
+            # format guessing
+            try:
+                tbl = ascii.read("".join(lines), format="fast_tab", guess=False)
+            except Exception:
+                tbl = ascii.read("".join(lines))
         except Exception as e:
             logger.warning("Failed to parse lines from %s: %s", cond_file, e)
             logger.debug("".join(lines))
@@ -508,16 +967,13 @@ def parse_weather_conditions(mr, force=False):
         if tbl.masked:
             tbl = tbl.filled()
 
-        dates = []
-        for row in tbl:
-            night = row["night"]
-            time = row["Time"]
-            d = datetime.datetime.strptime(f"{night}T{time}", "%Y-%m-%dT%H:%M")
-            if d.time() < NOON:
-                d += ONEDAY
-            dates.append(d.isoformat())
-
-        tbl["date"] = dates
+        # compute the dates for all the rows at once, the times before NOON
+        # being on the next day
+        dates = np.char.add(f"{night}T", np.asarray(tbl["Time"], dtype=str))
+        dates = dates.astype("datetime64[m]")
+        noon = np.timedelta64(NOON.hour * 60 + NOON.minute, "m")
+        dates[dates - dates.astype("datetime64[D]") < noon] += np.timedelta64(1, "D")
+        tbl["date"] = dates.astype("datetime64[s]").astype(str)
         tables.append(tbl)
 
     if len(tables) == 0:
@@ -534,7 +990,11 @@ def parse_weather_conditions(mr, force=False):
 
 
 def upsert_many(db, tablename, rows, keys):
-    """Use dataset.Table.upsert for a list of rows.
+    """Insert or update a list of rows, using ``keys`` to find existing rows.
+
+    Contrary to dataset.Table.upsert_many, which upserts the rows one by one,
+    the existing rows are found with a single query, and the rows are then
+    updated and inserted by batches, in one transaction.
 
     >>> import dataset
     >>> db = dataset.connect('sqlite:///:memory:')
@@ -544,12 +1004,53 @@ def upsert_many(db, tablename, rows, keys):
     >>> upsert_many(db, 'sometable', [dict(name='John Doe', age=42)], ['name'])
     >>> table.find_one()
     OrderedDict([('id', 1), ('name', 'John Doe'), ('age', 42)])
+    >>> upsert_many(db, 'sometable', [dict(name='Jane Doe', age=35, city='Lyon'),
+    ...                               dict(name='John Doe', city='Paris')], ['name'])
+    >>> for row in table.find(order_by='id'):
+    ...     print(row['name'], row['age'], row['city'])
+    John Doe 42 Paris
+    Jane Doe 35 Lyon
 
     """
+    # merge the rows with the same keys, the last values taking precedence
+    merged = OrderedDict()
+    for row in rows:
+        merged.setdefault(tuple(row[k] for k in keys), {}).update(row)
+    if not merged:
+        return
+
     with db as tx:
         table = tx[tablename]
-        for row in rows:
-            table.upsert(row, keys=keys)
+
+        # create the missing columns with a single schema update, using the
+        # first non-null value to guess the column type
+        columns = set(table.columns)
+        examples = {}
+        for row in merged.values():
+            for name, value in row.items():
+                if name not in columns and examples.get(name) is None:
+                    examples[name] = value
+        if examples:
+            table._sync_columns(examples, True)
+
+        # find the existing rows with one query
+        query = sql.select([table.table.c[k] for k in keys])
+        existing = {tuple(r) for r in tx.executable.execute(query)}
+
+        # rows to update are grouped by columns, since update_many sets the
+        # same columns for all the rows
+        to_update = defaultdict(list)
+        to_insert = []
+        for key, row in merged.items():
+            if key not in existing:
+                to_insert.append(row)
+            elif len(row) > len(keys):
+                to_update[tuple(sorted(row))].append(row)
+
+        for chunk in to_update.values():
+            table.update_many(chunk, keys)
+        if to_insert:
+            table.insert_many(to_insert)
 
 
 def join_tables(
@@ -628,9 +1129,14 @@ def join_tables(
 
 
 def all_subclasses(cls):
-    return set(cls.__subclasses__()).union(
-        [s for c in cls.__subclasses__() for s in all_subclasses(c)]
-    )
+    seen = set()
+    stack = [cls]
+    while stack:
+        for sub in stack.pop().__subclasses__():
+            if sub not in seen:
+                seen.add(sub)
+                stack.append(sub)
+    return seen
 
 
 def find_outliers(table, colname, name="name", exps=None, sigma_lower=5, sigma_upper=5):
@@ -660,16 +1166,17 @@ def find_outliers(table, colname, name="name", exps=None, sigma_lower=5, sigma_u
       std: standard deviation
     """
     logger = logging.getLogger(__name__)
+    # select only the two needed columns, instead of the full rows
+    c = table.table.c
+    query = sql.select([c[colname], c[name]], whereclause=c[colname].isnot(None))
     if exps is not None:
-        res = table.find(name=exps)
-    else:
-        res = table.find()
-    tab = [[e[colname], e[name]] for e in res if e[colname] is not None]
+        query = query.where(c.name.in_(exps))
+    tab = table.db.executable.execute(query).fetchall()
     if not tab:
         return
 
-    vals = list(zip(*tab))[0]
-    names = list(zip(*tab))[1]
+    vals = np.array([row[0] for row in tab])
+    names = np.array([row[1] for row in tab])
     vclip = sigma_clip(
         vals, sigma_lower=sigma_lower, sigma_upper=sigma_upper, copy=True
     )
@@ -684,15 +1191,26 @@ def find_outliers(table, colname, name="name", exps=None, sigma_lower=5, sigma_u
         nsig = []
         names = []
     else:
-        vals = np.array(vals)[vclip.mask]
+        vals = vals[vclip.mask]
+        nsig = ((vals - mean) / std).tolist()
         vals = vals.tolist()
-        nsig = (vals - mean) / std
-        nsig = nsig.tolist()
-        names = np.array(names)[vclip.mask]
-        names = names.tolist()
+        names = names[vclip.mask].tolist()
     return dict(names=names, vals=vals, nsig=nsig, mean=mean, std=std)
 
 
+def _select_qc_by_chan(table, qclist, run=None):
+    """Select the name and QC columns of a QC table with a single query, and
+    return the rows (as tuples) grouped by HDU name."""
+    c = table.table.c
+    query = sql.select([c.hdu, c.name] + [c[q] for q in qclist])
+    if run is not None:
+        query = query.where(c.run == run)
+    by_chan = defaultdict(list)
+    for hdu, *row in table.db.executable.execute(query):
+        by_chan[hdu].append(row)
+    return by_chan
+
+
 def stat_qc_chan(mr, table, qclist, nsigma=5, run=None):
     """Compute statitics of QC calibration table with 24 channels.
 
@@ -719,12 +1237,12 @@ def stat_qc_chan(mr, table, qclist, nsigma=5, run=None):
       nkeep: number of kept values
 
     """
-    table = mr.db[table]
-    find_kw = {"run": run} if run is not None else {}
+    by_chan = _select_qc_by_chan(mr.db[table], qclist, run=run)
     rows = []
     for k in range(1, 25):
-        for q in qclist:
-            vals = [c[q] for c in table.find(hdu=f"CHAN{k:02d}", **find_kw)]
+        chan_rows = by_chan[f"CHAN{k:02d}"]
+        for i, q in enumerate(qclist, start=1):
+            vals = [c[i] for c in chan_rows]
             clipvals = sigma_clip(vals, sigma=nsigma)
             rows.append(
                 {
@@ -766,16 +1284,13 @@ def find_outliers_qc_chan(mr, table, qclist, nsigma=5, run=None):
       nsig: rejection factors
 
     """
-    table = mr.db[table]
-    find_kw = {"run": run} if run is not None else {}
+    by_chan = _select_qc_by_chan(mr.db[table], qclist, run=run)
     rows = []
     for k in range(1, 25):
-        for q in qclist:
-            vals = []
-            names = []
-            for c in table.find(hdu=f"CHAN{k:02d}", **find_kw):
-                names.append(c["name"])
-                vals.append(c[q])
+        chan_rows = by_chan[f"CHAN{k:02d}"]
+        names = [c[0] for c in chan_rows]
+        for i, q in enumerate(qclist, start=1):
+            vals = [c[i] for c in chan_rows]
             clipvals = sigma_clip(vals, sigma=nsigma)
             if np.count_nonzero(clipvals.mask) == 0:
                 continue
@@ -821,6 +1336,65 @@ def ensure_list(value):
         return value
 
 
+def iter_fits_files(path, exclude_dirs=(".cache",)):
+    """Iterate over the FITS files in a directory and its subdirectories.
+
+    Directories are traversed with `os.scandir`, in the same order as
+    `os.walk`, and the directories with a name in ``exclude_dirs`` are
+    skipped. As with `os.walk`, symbolic links to directories are not
+    followed.
+
+    """
+    logger = logging.getLogger(__name__)
+    stack = [path]
+    while stack:
+        subdirs = []
+        with os.scandir(stack.pop()) as it:
+            for entry in it:
+                if entry.is_dir(follow_symlinks=False):
+                    if entry.name in exclude_dirs:
+                        logger.debug("skipping %s", entry.path)
+                    else:
+                        subdirs.append(entry.path)
+                elif entry.is_dir():
+                    continue  # symlink to a directory
+                elif entry.name.endswith((".fits", ".fits.fz")):
+                    yield entry.path
+        stack.extend(reversed(subdirs))
+
+
+def find_files(path, prefix, ext=".fits"):
+    """Return the files in ``path`` starting with ``prefix`` and ending with
+    ``ext``.
+
+    This is faster than ``glob`` as it avoids the pattern matching and uses
+    the directory entries directly. Returns an empty list if the directory
+    does not exist.
+
+    """
+    try:
+        with os.scandir(path) as it:
+            return [
+                e.path for e in it if e.name.startswith(prefix) and e.name.endswith(ext)
+            ]
+    except FileNotFoundError:
+        return []
+
+
+def write_fits_table(table, filename):
+    """Write an astropy Table to a FITS file.
+
+    The table is first written to a memory buffer and then to the file in a
+    single write, which avoids the many small writes done by astropy for the
+    header cards and the columns metadata.
+
+    """
+    buf = io.BytesIO()
+    table.write(buf, format="fits")
+    with open(filename, mode="wb") as f:
+        f.write(buf.getvalue())
+
+
 def make_band_images(cube, imgname, filter):
     """Create band images for cube with the given filters."""
     logger = logging.getLogger(__name__)
@@ -5,6 +5,7 @@ import shutil
 import textwrap
 
 import dataset
+import numpy as np
 import pytest
 from click.testing import CliRunner
 
@@ -358,3 +359,70 @@ def test_copy_reduced(tmpdir):
     assert mr.reduced.count() == 0
     mr.copy_reduced("0.1", ["muse_bias", "muse_flat"])
     assert mr.reduced.count() == 13
+
+
+def test_find_existing_exp(mr):
+    from musered.scripts.update_qa import _find_existing_exp, _find_existing_exps
+
+    mr.qa_reduced.update({"name": "2017-06-16T01:37:47.867", "skyB": None}, ["name"])
+    exists = _find_existing_exp(mr.qa_reduced, "skyB")
+    assert isinstance(exists, set)
+    assert len(exists) == 5
+    assert "2017-06-16T01:37:47.867" not in exists
+    assert _find_existing_exp(mr.qa_reduced, "IM_vers") == set()
+
+    exists = _find_existing_exps(mr.qa_reduced, ["skyB", "skyV", "IM_vers"])
+    assert exists["skyB"] == _find_existing_exp(mr.qa_reduced, "skyB")
+    assert len(exists["skyV"]) == 6
+    assert exists["IM_vers"] == set()
+
+
+def test_qa_sky(tmpdir):
+    from astropy.table import Table
+    from musered.scripts.update_qa import _sky
+
+    lbda = np.arange(4750, 9351, 1.25)
+    data = np.random.RandomState(42).uniform(1, 2, size=lbda.size).astype("f4")
+    # invalid values, before the bands and in the V band, are ignored
+    data[[10, 2000]] = np.nan
+    fname = str(tmpdir.join("SKY_SPECTRUM_0001.fits"))
+    Table({"lambda": lbda, "data": data}).write(fname)
+
+    res = _sky(fname)
+    for band, lmin, lmax in [
+        ("skyB", 4850, 6000),
+        ("skyV", 6000, 8000),
+        ("skyR", 8000, 9300),
+    ]:
+        mask = (lbda >= lmin) & (lbda <= lmax)
+        assert res[band] == pytest.approx(np.nanmean(data[mask], dtype=float))
+
+
+def test_qa_sparta(tmpdir, caplog):
+    from astropy.io import fits
+    from astropy.table import Table
+    from musered.scripts.update_qa import _sparta
+
+    rng = np.random.RandomState(42)
+    cols = {
+        f"LGS{k}_{col}": rng.uniform(0.5, 1.5, size=20)
+        for k in range(1, 5)
+        for col in ("SEEING", "TUR_GND", "L0")
+    }
+    cols["LGS4_TUR_GND"][0] = 0  # laser 4 not used
+    cols["LGS2_SEEING"][5] = np.nan  # invalid values are ignored
+    fname = str(tmpdir.join("raw.fits"))
+    hdu = fits.BinTableHDU(Table(cols), name="SPARTA_ATM_DATA")
+    fits.HDUList([fits.PrimaryHDU(), hdu]).writeto(fname)
+
+    res = _sparta(fname)
+    assert caplog.messages == ["Mode 3 lasers detected"]
+    seeing = [cols[f"LGS{k}_SEEING"] for k in range(1, 4)]
+    assert res["SP_See"] == pytest.approx(np.mean(np.nanmean(seeing, axis=1)))
+    assert res["SP_SeeStd"] == pytest.approx(np.std(np.nanmean(seeing, axis=1)))
+    assert res["SP_SeeMin"] == np.nanmin(seeing)
+    assert res["SP_SeeMax"] == np.nanmax(seeing)
+
+    fname = str(tmpdir.join("nosparta.fits"))
+    fits.PrimaryHDU().writeto(fname)
+    assert _sparta(fname) is None
@@ -3,16 +3,25 @@ import os
 import shutil
 
 import numpy as np
+from astropy.io import fits
+from astropy.table import Table
 
 from musered.utils import (
     dict_values,
     ensure_list,
+    find_files,
     find_outliers,
     find_outliers_qc_chan,
+    iter_fits_files,
+    load_db,
+    parse_gto_db,
     parse_qc_keywords,
     parse_raw_keywords,
     parse_weather_conditions,
+    read_raw_header,
     stat_qc_chan,
+    verify_fits_checksum,
+    write_fits_table,
 )
 
 CURDIR = os.path.dirname(os.path.abspath(__file__))
@@ -30,6 +39,116 @@ def test_ensure_list():
     assert ensure_list(np.array([1, 2])) == [1, 2]
 
 
+def test_find_files(tmpdir):
+    for name in ("IMAGE_FOV_0001.fits", "IMAGE_FOV_0002.fits", "PIXTABLE.fits"):
+        tmpdir.join(name).write("")
+    tmpdir.join("IMAGE_FOV_0001.txt").write("")
+    files = sorted(find_files(str(tmpdir), "IMAGE_FOV"))
+    assert [os.path.basename(f) for f in files] == [
+        "IMAGE_FOV_0001.fits",
+        "IMAGE_FOV_0002.fits",
+    ]
+    assert find_files(str(tmpdir.join("missing")), "IMAGE_FOV") == []
+
+
+def test_iter_fits_files(tmpdir):
+    for path in ("a.fits", "b.fits.fz", "c.txt", "sub/d.fits", ".cache/e.fits"):
+        tmpdir.join(path).ensure()
+    # symlinks to directories are not followed, which also avoids cycles
+    tmpdir.join("link").mksymlinkto(tmpdir.join("sub"))
+    tmpdir.join("sub", "loop").mksymlinkto(tmpdir)
+    files = sorted(iter_fits_files(str(tmpdir)))
+    assert [os.path.relpath(f, str(tmpdir)) for f in files] == [
+        "a.fits",
+        "b.fits.fz",
+        os.path.join("sub", "d.fits"),
+    ]
+
+
+def test_write_fits_table(tmpdir):
+    t = Table({"name": ["a", "b"], "val": [1.0, 2.0]}, meta={"FOO": "bar"})
+    fname = str(tmpdir.join("table.fits"))
+    write_fits_table(t, fname)
+    # write a second time to check that the file is overwritten
+    write_fits_table(t, fname)
+
+    t2 = Table.read(fname)
+    assert t2.meta["FOO"] == "bar"
+    assert t2["name"].tolist() == ["a", "b"]
+    assert t2["val"].tolist() == [1.0, 2.0]
+
+
+def test_verify_fits_checksum(tmpdir):
+    hdul = fits.HDUList(
+        [
+            fits.PrimaryHDU(),
+            fits.ImageHDU(np.arange(35 * 53, dtype=float).reshape(35, 53)),
+            fits.BinTableHDU(Table({"a": np.arange(10), "b": ["foo"] * 10})),
+        ]
+    )
+    fname = str(tmpdir.join("valid.fits"))
+    hdul.writeto(fname, checksum=True)
+    assert verify_fits_checksum(fname) == 3
+
+    with open(fname, mode="rb") as f:
+        content = bytearray(f.read())
+
+    # modify one byte in the image data
+    invalid = content.copy()
+    invalid[2 * 2880 + 100] ^= 1
+    fname = str(tmpdir.join("invalid.fits"))
+    with open(fname, mode="wb") as f:
+        f.write(invalid)
+    assert verify_fits_checksum(fname) is None
+
+    # truncated file
+    fname = str(tmpdir.join("truncated.fits"))
+    with open(fname, mode="wb") as f:
+        f.write(content[:-2880])
+    assert verify_fits_checksum(fname) is None
+
+    # no checksum
+    testfile = os.path.join(CURDIR, "data", "MUSE.2017-06-16T01:34:56.867.fits")
+    assert verify_fits_checksum(testfile) is None
+
+    # only one of the CHECKSUM and DATASUM keywords, the other one is written
+    # with a different name
+    for kwargs in ({"datasum_keyword": "DATASUX"}, {"checksum_keyword": "CHECKSUX"}):
+        hdul = fits.HDUList([fits.PrimaryHDU(np.arange(100, dtype=float))])
+        hdul[0].add_checksum(**kwargs)
+        fname = str(tmpdir.join("onekeyword.fits"))
+        hdul.writeto(fname, overwrite=True, checksum=False)
+        assert verify_fits_checksum(fname) is None
+
+
+def test_parse_gto_db(tmpdir):
+    db = load_db(str(tmpdir.join("musered.db")))
+    db["raw"].insert_many(
+        [
+            {
+                "name": "a",
+                "ARCFILE": "a.fits",
+                "OBS_START": "2017",
+                "DPR_TYPE": "OBJECT",
+            },
+            {"name": "b", "ARCFILE": "b.fits", "OBS_START": None, "DPR_TYPE": "OBJECT"},
+        ]
+    )
+    gtofile = str(tmpdir.join("gto.db"))
+    gtodb = load_db(gtofile)
+    gtodb["OBflags"].insert({"OBstart": "2017", "flag": 2})
+    gtodb["fcomments"].insert(
+        {"arcfile": "b.fits", "comment": "foo", "date": "", "author": "bar"}
+    )
+    gtodb.engine.dispose()
+
+    table = parse_gto_db(db, [gtofile])
+    rows = {row["name"]: row for row in table.find()}
+    assert rows["a"]["flag"] == "A"
+    assert rows["b"]["flag"] == ""
+    assert rows["b"]["fcomment"] == "foo"
+
+
 def test_parse_keywords(mr, caplog, tmpdir):
     caplog.set_level(logging.WARNING)
     testfile = os.path.join(CURDIR, "data", "MUSE.2017-06-16T01:34:56.867.fits")
@@ -76,6 +195,44 @@ def test_parse_keywords(mr, caplog, tmpdir):
         assert row[key] == expected
 
 
+def test_read_raw_header(tmpdir):
+    hdr = fits.Header()
+    hdr["OBJECT"] = "-".join(["a long object name"] * 5)
+    hdr["HIERARCH ESO OBS NAME"] = "IC4406"
+    hdr["EXPTIME"] = 1.5
+    hdr.append(("EXPTIME", 2.5))  # duplicate keyword
+    hdr["UNDEF"] = None  # undefined value
+    # long HIERARCH keyword, written without space before the "="
+    hdr["HIERARCH ESO INS LONG KEYWORD NAME FOR TESTING"] = "a long string value"
+    fname = str(tmpdir.join("raw.fits"))
+    fits.PrimaryHDU(header=hdr).writeto(fname)
+
+    keys = [
+        "OBJECT",
+        "ESO OBS NAME",
+        "HIERARCH ESO OBS NAME",
+        "eso obs name",
+        "exptime",
+        "ESO INS LONG KEYWORD NAME FOR TESTING",
+        "NAXIS",
+        "UNDEF",
+        "MISSING",
+    ]
+    hdr = fits.getheader(fname)
+    assert read_raw_header(fname, keys) == {key: hdr.get(key) for key in keys}
+    assert read_raw_header(fname, ["EXPTIME"]) == {"EXPTIME": 1.5}
+
+
+def test_parse_keywords_parallel(mr):
+    testfile = os.path.join(CURDIR, "data", "MUSE.2017-06-16T01:34:56.867.fits")
+    kwargs = dict(runs=mr.conf.get("runs"))
+    rows = parse_raw_keywords([testfile] * 2, mr.datasets, **kwargs)
+    rows2 = parse_raw_keywords([testfile] * 2, mr.datasets, n_jobs=2, **kwargs)
+    for row in rows + rows2:
+        del row["date_import"]
+    assert rows2 == rows
+
+
 def test_parse_qc(mr):
     testfile = os.path.join(CURDIR, "data", "MUSE.2017-06-16T01:34:56.867.fits")
     rows = parse_qc_keywords([testfile])
@@ -93,6 +250,24 @@ def test_parse_qc(mr):
         assert row[key] == expected
 
 
+def test_parse_qc_extensions(tmpdir):
+    hdr = fits.Header()
+    hdr["HIERARCH ESO QC NAME"] = "foo"
+    hdr["HIERARCH ESO QC VAL"] = 1.5
+    hdus = [fits.PrimaryHDU(np.ones((3, 5)), header=hdr)]
+    for name in ("CHAN01", "CHAN01.DQ", "CHAN01.STAT"):
+        hdr = fits.Header()
+        hdr["HIERARCH ESO QC NVAL"] = 2
+        hdus.append(fits.ImageHDU(np.ones((7, 11), dtype="i2"), header=hdr, name=name))
+    fname = str(tmpdir.join("qc.fits"))
+    fits.HDUList(hdus).writeto(fname)
+
+    assert parse_qc_keywords([fname]) == [
+        {"filename": "qc.fits", "hdu": "PRIMARY", "QC_NAME": "foo", "QC_VAL": 1.5},
+        {"filename": "qc.fits", "hdu": "CHAN01", "QC_NVAL": 2},
+    ]
+
+
 def test_parse_weather(mr, caplog):
     parse_weather_conditions(mr)
     assert caplog.messages == [